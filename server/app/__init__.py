@@ -2,17 +2,45 @@
 Initialize the webserver.
 """
 
+import atexit
 import logging
 import os
+import queue
 import time
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueListener, RotatingFileHandler
 
-import pandas as pd
 from flask import Flask
 from app.task_runner import ThreadPool
 from app.requests_solver import RequestsSolver
+from app.result_store import create_result_store
+from app.dataset import memory_report
+from app.job_registry import JobRegistry
+from app.dataset_reloader import DatasetReloader, build_dataset
+from app.ingestion import IngestionLog
+from app.rate_limiter import RateLimiter
+from app.metrics import Counter, Histogram
+from app.async_logging import LazyQueueHandler, PayloadSampler, RouteLevelFilter, parse_route_levels
 
 webserver = Flask(__name__)
+webserver.start_time = time.perf_counter()
+webserver.first_request_served = False
+# Requests served by each route, exposed by /api/metrics
+webserver.http_requests = Counter(
+    "webserver_http_requests_total",
+    "HTTP requests served, by route, method and status code",
+    ("route", "method", "code"),
+)
+webserver.http_request_seconds = Histogram(
+    "webserver_http_request_seconds",
+    "Time spent serving the HTTP requests, by route",
+    ("route",),
+)
+webserver.job_requests = Counter(
+    "webserver_job_requests_total",
+    "Job-generating requests, by endpoint function and outcome "
+    "(accepted, rate_limited or saturated)",
+    ("endpoint", "outcome"),
+)
 
 # Create the logger for the webserver
 webserver.logger = logging.getLogger(__name__)
@@ -23,21 +51,91 @@ logging.getLogger("werkzeug").disabled = True
 logging.Formatter.converter = time.gmtime
 
 # Configure the logger to use a RotatingFileHandler and a specific format
+# The request threads only put the records in a queue, and a background listener
+# formats them and writes them to the file
 os.makedirs("logging", exist_ok=True)
-logging.basicConfig(
-    handlers=[RotatingFileHandler("logging/webserver.log", maxBytes=1000000, backupCount=10)],
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+file_handler = RotatingFileHandler("logging/webserver.log", maxBytes=1000000, backupCount=10)
+file_handler.setFormatter(logging.Formatter(
+    "[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
     datefmt="%d-%b-%y %H:%M:%S",
+))
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+# Check if environment variable LOG_ROUTE_LEVELS is defined
+# It sets the minimum level of the messages logged while serving some routes,
+# e.g. "/api/jobs=WARNING,/api/get_results/<job_id>=WARNING"
+queue_handler.addFilter(RouteLevelFilter(parse_route_levels(os.getenv("LOG_ROUTE_LEVELS", ""))))
+# Check if environment variable LOG_LEVEL is defined (INFO by default)
+logging.basicConfig(handlers=[queue_handler], level=os.getenv("LOG_LEVEL", "INFO").upper())
+webserver.log_listener = QueueListener(log_queue, file_handler)
+webserver.log_listener.start()
+# Write the records left in the queue when the webserver stops
+atexit.register(webserver.log_listener.stop)
+
+# Check if environment variables LOG_PAYLOAD_SAMPLE_RATE and LOG_PAYLOAD_MAX_CHARS are defined
+# The request payloads and the job lists are logged for that fraction of the requests
+# (all by default), capped at that many characters (1000 by default, 0 means no cap)
+webserver.log_payload = PayloadSampler(
+    float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1")),
+    int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "1000")),
 )
 
 webserver.logger.info("Webserver initialized")
 
+webserver.data_path = "./nutrition_activity_obesity_usa_subset.csv"
+# Check if environment variable DATA_SNAPSHOT is defined
+# If it is set to 0, always parse the CSV instead of using the binary snapshot
+webserver.data_snapshot = os.getenv("DATA_SNAPSHOT", "1") != "0"
+# Engine that answers the requests. By default, the sums and counts
+# needed by the requests are precomputed in an aggregate index
+webserver.engine_name = os.getenv("SOLVER_ENGINE", "index")
+
+# Check if environment variable DATA_CHUNK_ROWS is defined
+# If it is, the CSV is streamed in chunks of DATA_CHUNK_ROWS rows into the aggregate
+# index instead of being loaded in memory, for CSVs larger than the memory
+webserver.data_chunk_rows = int(os.getenv("DATA_CHUNK_ROWS", "0"))
+# Check if environment variable INGESTION_LOG is defined
+# The rows ingested through /api/ingest are appended to this log, which is
+# replayed on top of the CSV when the dataset is loaded
+webserver.ingestion_log = IngestionLog(
+    os.getenv("INGESTION_LOG", f"{webserver.data_path}.ingest.jsonl")
+)
+
+# Check if environment variable DATA_LAZY_LOAD is defined
+# By default, the dataset is loaded in a background thread, so that the webserver
+# listens at once: the jobs submitted meanwhile wait for it and /api/ready reports
+# the progress. If it is set to 0, the dataset is loaded before the webserver starts
+webserver.data_lazy_load = os.getenv("DATA_LAZY_LOAD", "1") != "0"
+if webserver.data_lazy_load:
+    webserver.data, webserver.solver_engine = None, None
+else:
+    webserver.data, webserver.solver_engine, _ = build_dataset(webserver)
+    webserver.logger.info(
+        "Dataset loaded and solver engine %s built in %.3fs: %s", webserver.engine_name,
+        time.perf_counter() - webserver.start_time, memory_report(webserver.data)
+    )
 webserver.tasks_runner = ThreadPool(webserver)
-webserver.data = pd.read_csv("./nutrition_activity_obesity_usa_subset.csv")
+# Check if environment variables RATE_LIMIT_PER_SECOND and RATE_LIMIT_BURST are defined
+# By default, the number of requests a client can make is not limited
+rate_limit = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+webserver.rate_limiter = RateLimiter(
+    rate_limit, float(os.getenv("RATE_LIMIT_BURST", str(max(rate_limit, 1))))
+)
 webserver.requests_solver = RequestsSolver(webserver)
+webserver.result_store = create_result_store()
+
+# Check if environment variable JOB_TTL is defined
+# Finished jobs are forgotten JOB_TTL seconds after they finish (1 hour by default)
+webserver.jobs = JobRegistry(
+    float(os.getenv("JOB_TTL", "3600")), on_evict=webserver.result_store.delete
+)
 
-webserver.job_counter = 1
-webserver.job_status = {}
+# Check if environment variable DATA_WATCH_INTERVAL is defined
+# If it is, the CSV is checked for changes every DATA_WATCH_INTERVAL seconds and reloaded
+# in the background. The reload can also be started through /api/reload
+webserver.reloader = DatasetReloader(webserver, float(os.getenv("DATA_WATCH_INTERVAL", "0")))
+if webserver.data_lazy_load:
+    webserver.tasks_runner.data_ready.clear()
+    webserver.reloader.reload()
 
 from app import routes
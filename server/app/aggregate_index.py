@@ -0,0 +1,188 @@
+"""
+Module that contains the precomputed aggregate index over the dataset
+"""
+
+import math
+
+import numpy as np
+
+def _exact_partials(values):
+    """
+    Represent the exact sum of values as a tuple of floats: the correctly rounded sum
+    (math.fsum), then the correctly rounded remainders, until nothing remains
+    Merging the partials of two sets of values gives the partials of their union,
+    so the rounded sum doesn't depend on how the values were split
+    """
+    terms = list(values)
+    partials = []
+    while True:
+        partial = math.fsum(terms)
+        if partial == 0.0 or not math.isfinite(partial):
+            if not partials:
+                partials.append(partial)
+            return tuple(partials)
+        partials.append(partial)
+        terms.append(-partial)
+
+def _mean(total, count):
+    """
+    Compute a mean from a running sum and count, returning NaN for empty groups
+    (the same value pandas returns when a group has no valid Data_Value)
+    """
+    if count == 0:
+        return math.nan
+    return total / count
+
+def _sort_key(item):
+    """
+    Sort key used for the states means: ascending by value, NaN values last
+    """
+    return (math.isnan(item[1]), item[1])
+
+class AggregateIndex:
+    """
+    Class that holds the sum and count of Data_Value for each question,
+    each (question, state) pair and each (question, state, category, stratification)
+    group, so that the requests can be answered without scanning the dataset
+    The sums are kept exactly, as partials, so adding the rows at once or in chunks
+    (when streaming or ingesting) gives the same correctly rounded sums
+    """
+    def __init__(self, data = None):
+        # question -> [sum, count, partials]
+        self.questions = {}
+        # question -> state -> [sum, count, partials]
+        self.states = {}
+        # question -> state -> (category, stratification) -> [sum, count, partials]
+        self.categories = {}
+
+        if data is not None:
+            self.add_rows(data)
+
+    def add_rows(self, data):
+        """
+        Add the sums and counts of the given rows to the index
+        """
+        if data.empty:
+            return
+
+        values = data["Data_Value"]
+        for question, partials, count in self._grouped_partials(values, data["Question"]):
+            self._add(self.questions, question, partials, count)
+
+        for (question, state), partials, count in self._grouped_partials(
+            values, [data["Question"], data["LocationDesc"]]):
+            self._add(self.states.setdefault(question, {}), state, partials, count)
+
+        if "StratificationCategory1" not in data or "Stratification1" not in data:
+            return
+
+        for (question, state, category, stratification), partials, count in \
+            self._grouped_partials(values, [
+                data["Question"],
+                data["LocationDesc"],
+                data["StratificationCategory1"],
+                data["Stratification1"],
+            ]):
+            self._add(
+                self.categories.setdefault(question, {}).setdefault(state, {}),
+                (category, stratification),
+                partials,
+                count,
+            )
+
+    @staticmethod
+    def _grouped_partials(values, keys):
+        """
+        Get the key, the exact partial sums and the count of the values of each group
+        """
+        grouped = values.groupby(keys, observed=True)
+        counts = grouped.count()
+        codes = grouped.ngroup().to_numpy()
+        order = np.argsort(codes, kind="stable")
+        # The missing values are not counted and add nothing to the sums
+        sorted_values = np.nan_to_num(values.to_numpy(dtype=np.float64)[order], nan=0.0)
+        bounds = np.searchsorted(codes[order], np.arange(1, len(counts)))
+        return zip(
+            counts.index,
+            map(_exact_partials, np.split(sorted_values, bounds)),
+            counts.to_numpy(),
+        )
+
+    def with_rows(self, data):
+        """
+        Get a new index with the given rows added, leaving this one unchanged
+        Only the entries of the questions of the new rows are copied, the others are shared
+        """
+        touched = set(data["Question"])
+        index = AggregateIndex()
+        index.questions = {
+            question: list(entry) if question in touched else entry
+            for question, entry in self.questions.items()
+        }
+        index.states = {
+            question: {state: list(entry) for state, entry in states.items()}
+            if question in touched else states
+            for question, states in self.states.items()
+        }
+        index.categories = {
+            question: {
+                state: {key: list(entry) for key, entry in groups.items()}
+                for state, groups in states.items()
+            } if question in touched else states
+            for question, states in self.categories.items()
+        }
+        index.add_rows(data)
+        return index
+
+    @staticmethod
+    def _add(groups, key, partials, count):
+        """
+        Add the partial sums and the count of some rows to the entry of a group
+        """
+        entry = groups.setdefault(key, [0.0, 0, ()])
+        entry[2] = _exact_partials(entry[2] + partials)
+        entry[0] = entry[2][0]
+        entry[1] += int(count)
+
+    def states_mean(self, question):
+        """
+        Average value for a question for each state, sorted by value
+        """
+        means = [
+            (state, _mean(total, count))
+            for state, (total, count, _) in sorted(self.states.get(question, {}).items())
+        ]
+        return dict(sorted(means, key=_sort_key))
+
+    def state_mean(self, question, state):
+        """
+        Average value for a question for a specific state
+        """
+        total, count, _ = self.states.get(question, {}).get(state, (0.0, 0, ()))
+        return {state: _mean(total, count)}
+
+    def global_mean(self, question):
+        """
+        Global average value for a question
+        """
+        total, count, _ = self.questions.get(question, (0.0, 0, ()))
+        return {"global_mean": _mean(total, count)}
+
+    def mean_by_category(self, question):
+        """
+        Average value for a question for each state and each subcategory in a category
+        """
+        result = {}
+        for state, groups in sorted(self.categories.get(question, {}).items()):
+            for (category, stratification), (total, count, _) in sorted(groups.items()):
+                result[str((state, category, stratification))] = _mean(total, count)
+        return result
+
+    def state_mean_by_category(self, question, state):
+        """
+        Average value for a question for a specific state and each subcategory in a category
+        """
+        groups = self.categories.get(question, {}).get(state, {})
+        return {state: {
+            str(key): _mean(total, count) for key, (total, count, _) in sorted(groups.items())
+        }}
@@ -0,0 +1,90 @@
+"""
+Module that contains the pieces of the asynchronous logging pipeline: the records
+are put in a queue by the request threads and formatted and written to the file
+by a background listener thread
+"""
+
+import logging
+import random
+from logging.handlers import QueueHandler
+
+from flask import has_request_context, request
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of the records to the listener thread
+    The arguments of a record are formatted after the call that logged it returns,
+    so they must not be changed afterwards
+    """
+    def prepare(self, record):
+        """
+        Prepare a record for the queue without formatting its message
+        """
+        if record.exc_info:
+            # The traceback can't be put in the queue, so it is formatted right away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class RouteLevelFilter(logging.Filter):
+    """
+    Filter that drops the records logged while serving a route below the level of the route
+    The records logged outside of a request, or for other routes, are kept
+    """
+    def __init__(self, levels):
+        super().__init__()
+        self.levels = levels
+
+    def filter(self, record):
+        """
+        Check whether the record is at least at the level of its route
+        """
+        if not self.levels or not has_request_context() or request.url_rule is None:
+            return True
+
+        level = self.levels.get(request.url_rule.rule)
+        return level is None or record.levelno >= level
+
+def parse_route_levels(value):
+    """
+    Parse the log levels of the routes, given as "route=LEVEL,route=LEVEL"
+    """
+    levels = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        route, _, level = item.rpartition("=")
+        if not route or not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError(f"Invalid route log level: {item}")
+        levels[route] = logging.getLevelName(level.upper())
+    return levels
+
+class Payload:
+    """
+    Payload logged lazily: it is only converted to a string, capped at max_chars
+    characters, if the record is written
+    """
+    def __init__(self, payload, max_chars):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self):
+        text = str(self.payload)
+        if 0 < self.max_chars < len(text):
+            return f"{text[:self.max_chars]}... ({len(text)} characters)"
+        return text
+
+class PayloadSampler:
+    """
+    Decides which payloads are logged: a sample_rate fraction of them, each capped
+    at max_chars characters (0 means no cap)
+    """
+    def __init__(self, sample_rate, max_chars):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+
+    def __call__(self, payload):
+        """
+        Get the payload to log, or a placeholder if it is not sampled
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return "<not sampled>"
+        return Payload(payload, self.max_chars)
@@ -0,0 +1,207 @@
+"""
+Module that loads the dataset in a compact columnar form
+
+The parsed dataset is cached in a binary snapshot next to the CSV: one .npy file
+per column (the codes for the categorical columns) and a meta.json file with the
+categories and the fingerprint (size, mtime and content hash) of the CSV
+
+CSVs larger than the memory can instead be streamed in chunks straight into the
+aggregate index, without keeping the rows
+"""
+
+import hashlib
+import json
+import logging
+import os
+import resource
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from app.aggregate_index import AggregateIndex
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 1
+
+# The only columns used by the requests
+CATEGORICAL_COLUMNS = ["Question", "LocationDesc", "StratificationCategory1", "Stratification1"]
+COLUMNS = CATEGORICAL_COLUMNS + ["Data_Value"]
+DTYPES = {column: "category" for column in CATEGORICAL_COLUMNS} | {"Data_Value": "float64"}
+
+class ProgressFile:
+    """
+    Binary file wrapper that reports the number of bytes read so far, and the size
+    of the file, to a progress callback
+    """
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.bytes_read = 0
+        self.size = os.fstat(file.fileno()).st_size
+
+    def read(self, size = -1):
+        """
+        Read from the file and report the progress
+        """
+        block = self.file.read(size)
+        self.bytes_read += len(block)
+        self.progress(self.bytes_read, self.size)
+        return block
+
+    def __iter__(self):
+        """
+        Iterate over the lines of the file
+        """
+        return iter(self.file)
+
+def read_csv(path, progress = None):
+    """
+    Read only the columns used by the requests from the CSV, store the string columns
+    as categoricals and drop the rows without a Data_Value
+    """
+    with open(path, "rb") as file:
+        data = pd.read_csv(
+            ProgressFile(file, progress) if progress is not None else file,
+            usecols=COLUMNS,
+            dtype=DTYPES,
+        )
+    return data.dropna(subset=["Data_Value"]).reset_index(drop=True)
+
+def stream_index(path, chunk_rows, progress = None):
+    """
+    Build the aggregate index by reading the CSV in chunks of chunk_rows rows, each
+    reduced into the sums and counts of its groups and then discarded, so that the
+    memory used depends on chunk_rows and the number of groups, not on the size of the CSV
+    """
+    index = AggregateIndex()
+    rows = 0
+    with open(path, "rb") as file, pd.read_csv(
+        ProgressFile(file, progress) if progress is not None else file,
+        usecols=COLUMNS,
+        dtype=DTYPES,
+        chunksize=chunk_rows,
+    ) as chunks:
+        for chunk in chunks:
+            chunk = chunk.dropna(subset=["Data_Value"])
+            index.add_rows(chunk)
+            rows += len(chunk)
+
+    logger.info("Dataset streamed into the aggregate index: %s rows", rows)
+    return index
+
+def fingerprint(path):
+    """
+    Compute the fingerprint of the CSV that identifies a valid snapshot
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+
+    stat = os.stat(path)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest.hexdigest(),
+    }
+
+def write_snapshot(data, directory, csv_fingerprint):
+    """
+    Write the dataset to a snapshot directory
+    The snapshot is written to a temporary directory that then replaces the old one
+    """
+    temp_directory = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    meta = {"fingerprint": csv_fingerprint, "categories": {}}
+    for column in CATEGORICAL_COLUMNS:
+        np.save(os.path.join(temp_directory, f"{column}.npy"), data[column].cat.codes.to_numpy())
+        meta["categories"][column] = data[column].cat.categories.tolist()
+    np.save(os.path.join(temp_directory, "Data_Value.npy"), data["Data_Value"].to_numpy())
+
+    with open(os.path.join(temp_directory, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+
+def read_snapshot(directory, csv_fingerprint):
+    """
+    Read the dataset from a snapshot directory, memory-mapping the column files
+    Returns None if there is no snapshot or it was built from a different CSV
+    """
+    try:
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("fingerprint") != csv_fingerprint:
+        return None
+
+    columns = {}
+    for column in CATEGORICAL_COLUMNS:
+        codes = np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")
+        columns[column] = pd.Categorical.from_codes(
+            codes, categories=meta["categories"][column]
+        )
+    columns["Data_Value"] = np.load(os.path.join(directory, "Data_Value.npy"), mmap_mode="r")
+    # Keep the columns backed by the mapped files, so that the processes that load
+    # the same snapshot share its pages instead of each holding a copy
+    return pd.DataFrame(columns, copy=False)
+
+def load_dataset(path, snapshot = True, progress = None):
+    """
+    Load the dataset from the snapshot next to the CSV if it is valid, otherwise
+    parse the CSV (reporting the progress of the parsing to progress, if given)
+    and rebuild the snapshot
+    """
+    if not snapshot:
+        return read_csv(path, progress)
+
+    directory = f"{path}.snapshot"
+    csv_fingerprint = fingerprint(path)
+    data = read_snapshot(directory, csv_fingerprint)
+    if data is not None:
+        logger.info("Dataset loaded from snapshot %s", directory)
+        return data
+
+    data = read_csv(path, progress)
+    try:
+        write_snapshot(data, directory, csv_fingerprint)
+        logger.info("Snapshot %s rebuilt", directory)
+    except OSError as exception:
+        logger.error("Could not write snapshot %s: %s", directory, exception)
+    return data
+
+def current_rss_bytes():
+    """
+    Get the current resident memory of the process, in bytes,
+    or None where /proc/self/statm is not available
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+def memory_report(data):
+    """
+    Get the memory used by each column of the dataset, in bytes,
+    along with the current and peak resident memory of the process
+    """
+    columns = data.memory_usage(index=False, deep=True)
+    return {
+        "rows": len(data),
+        "columns": {column: int(size) for column, size in columns.items()},
+        "dataset_bytes": int(columns.sum()),
+        # ru_maxrss is reported in kilobytes on Linux
+        "process_rss_bytes": current_rss_bytes(),
+        "process_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
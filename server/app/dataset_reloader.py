@@ -0,0 +1,209 @@
+"""
+Module that reloads the dataset in the background and swaps it in atomically
+"""
+
+import logging
+import os
+import time
+from threading import Lock, Thread
+
+from app.aggregate_index import AggregateIndex
+from app.dataset import load_dataset, memory_report, stream_index
+from app.ingestion import append_rows, rows_to_frame
+from app.requests_solver import create_engine
+
+logger = logging.getLogger(__name__)
+
+def build_dataset(webserver, progress = None):
+    """
+    Load the dataset and build its engine, with the rows of the ingestion log added
+    With data_chunk_rows, the CSV is streamed into the aggregate index and only
+    an empty dataset is kept
+    The progress of the reading of the CSV is reported to progress, if given
+    Returns the dataset, the engine and the number of lines read from the ingestion log
+    """
+    if webserver.data_chunk_rows > 0:
+        if webserver.engine_name != "index":
+            raise ValueError("Streaming the dataset requires the index engine")
+
+        engine = stream_index(webserver.data_path, webserver.data_chunk_rows, progress)
+        rows, log_lines = webserver.ingestion_log.read()
+        if rows:
+            engine.add_rows(rows_to_frame(rows))
+        return rows_to_frame([]), engine, log_lines
+
+    data = load_dataset(webserver.data_path, webserver.data_snapshot, progress)
+    data, log_lines = webserver.ingestion_log.replay(data)
+    return data, create_engine(webserver.engine_name, data), log_lines
+
+class DatasetReloader:
+    """
+    Class that loads a new version of the CSV and builds its engine in a background
+    thread, then swaps them in at once: the jobs that already read the engine finish
+    with it, while the new jobs use the new one
+    With a watch_interval, the CSV is checked for changes every watch_interval seconds
+    The ingested rows are added to a copy of the engine that is swapped in the same way
+    If the webserver has no dataset yet, the first reload loads it
+    """
+    def __init__(self, webserver, watch_interval = 0):
+        self.webserver = webserver
+        self.watch_interval = watch_interval
+
+        # Generation 0 means that the dataset is still being loaded for the first time
+        self.generation = 0 if webserver.solver_engine is None else 1
+        self.loaded_at = None if webserver.solver_engine is None else time.time()
+        # Fraction of the CSV read by the reload in progress
+        self.progress = None
+        self.last_error = None
+        self.reloading = False
+        self.ingested_rows = 0
+        self.lock = Lock()
+        # Serializes the swaps, so that the dataset and the engine always match
+        self.swap_lock = Lock()
+
+        if watch_interval > 0:
+            Thread(target=self.watch, daemon=True).start()
+
+    def _csv_version(self):
+        """
+        Get the size and modification time of the CSV, or None if it can't be read
+        """
+        try:
+            stat = os.stat(self.webserver.data_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def reload(self):
+        """
+        Start reloading the dataset in a background thread
+        Returns False if a reload is already in progress
+        """
+        with self.lock:
+            if self.reloading:
+                return False
+            self.reloading = True
+            self.progress = 0.0
+
+        Thread(target=self._reload, daemon=True).start()
+        return True
+
+    def _report_progress(self, bytes_read, size):
+        """
+        Record the fraction of the CSV read by the reload in progress
+        """
+        self.progress = bytes_read / size if size else 1.0
+
+    def _reload(self):
+        """
+        Load the CSV and build its engine, then swap them in
+        The current dataset keeps being used if the CSV can't be loaded, and without
+        a dataset, the jobs keep waiting for the next reload
+        """
+        start_time = time.perf_counter()
+        first_load = self.webserver.solver_engine is None
+        try:
+            self.swap(*build_dataset(self.webserver, self._report_progress))
+            logger.info(
+                "Dataset %s and solver engine %s built in %.3fs: %s",
+                "loaded" if first_load else "reloaded", self.webserver.engine_name,
+                time.perf_counter() - start_time, memory_report(self.webserver.data),
+            )
+            error = None
+        except Exception as exception: # pylint: disable=broad-exception-caught
+            logger.error("Could not load the dataset: %s", exception)
+            error = str(exception)
+
+        with self.lock:
+            self.reloading = False
+            self.progress = None
+            self.last_error = error
+
+    def swap(self, data, engine, log_lines = None):
+        """
+        Make a dataset and its engine the ones used by the new jobs
+        If the dataset was built with the first log_lines lines of the ingestion log,
+        the rows ingested since then are added before the swap
+        """
+        with self.swap_lock:
+            if log_lines is not None:
+                rows, _ = self.webserver.ingestion_log.read(log_lines)
+                if rows:
+                    # A streamed dataset keeps no rows
+                    if self.webserver.data_chunk_rows <= 0:
+                        data = append_rows(data, rows)
+                    if isinstance(engine, AggregateIndex):
+                        engine = engine.with_rows(rows_to_frame(rows))
+                    else:
+                        engine = create_engine(self.webserver.engine_name, data)
+
+            # With the process backend, the worker processes for the new dataset
+            # are started before the new jobs can use its engine
+            self.webserver.tasks_runner.swap_dataset(data, engine)
+            self.webserver.data = data
+            self.webserver.solver_engine = engine
+            # The jobs queued while the dataset was loaded for the first time only
+            # start once they can read its engine
+            self.webserver.tasks_runner.release_pending_jobs()
+
+            with self.lock:
+                self.generation += 1
+                self.loaded_at = time.time()
+                # The rows ingested until now are part of the new dataset
+                self.ingested_rows = 0
+
+    def ingest(self, rows):
+        """
+        Durably log parsed rows and swap in a copy of the engine with the rows added
+        Only the groups of the new rows are updated, without scanning the dataset,
+        so this requires the aggregate index engine. It also requires the thread backend,
+        since the worker processes of the process backend only know the dataset they
+        were started with
+        While the dataset is loaded for the first time, the rows are only logged
+        and added by the load
+        """
+        if self.webserver.engine_name != "index":
+            raise TypeError("Ingestion requires the index engine")
+        if self.webserver.tasks_runner.backend != "thread":
+            raise TypeError("Ingestion requires the thread backend")
+        if not rows:
+            return
+
+        frame = rows_to_frame(rows)
+        with self.swap_lock:
+            self.webserver.ingestion_log.append(rows)
+            if self.webserver.solver_engine is None:
+                return
+            self.webserver.solver_engine = self.webserver.solver_engine.with_rows(frame)
+            with self.lock:
+                self.ingested_rows += len(rows)
+
+    def watch(self):
+        """
+        Reload the dataset whenever the CSV changes
+        """
+        version = self._csv_version()
+        while True:
+            time.sleep(self.watch_interval)
+            new_version = self._csv_version()
+            if new_version is not None and new_version != version and self.reload():
+                logger.info("Change of %s detected", self.webserver.data_path)
+                version = new_version
+
+    def status(self):
+        """
+        Get the generation of the dataset, the time it was loaded at and
+        the state of the last reload, with the fraction of the CSV it read so far
+        """
+        data = self.webserver.data
+        with self.lock:
+            return {
+                "ready": self.generation > 0,
+                "generation": self.generation,
+                "loaded_at": self.loaded_at,
+                "reloading": self.reloading,
+                "progress": self.progress,
+                "last_error": self.last_error,
+                "rows": len(data) if data is not None else 0,
+                "ingested_rows": self.ingested_rows,
+            }
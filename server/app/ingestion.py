@@ -0,0 +1,136 @@
+"""
+Module that contains the incremental ingestion of rows: the validation of the new rows
+and the log they are appended to, which is replayed on top of the CSV at startup
+"""
+
+import json
+import logging
+import math
+import os
+from threading import Lock
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from app.dataset import CATEGORICAL_COLUMNS, COLUMNS, DTYPES
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of rows that can be ingested in a single request
+MAX_INGEST_ROWS = 10000
+
+def parse_rows(rows):
+    """
+    Check the validity of the rows to ingest, given as a list of objects with
+    the dataset's columns, and return them with only those columns
+    Rows without a Data_Value are dropped, like when the CSV is read
+    Raises ValueError if the rows are invalid
+    """
+    if not isinstance(rows, list) or not 0 < len(rows) <= MAX_INGEST_ROWS:
+        raise ValueError(f"Expected a list of 1 to {MAX_INGEST_ROWS} rows")
+
+    parsed_rows = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ValueError(f"Invalid row: {row}")
+        if any(not isinstance(row.get(column), str) for column in CATEGORICAL_COLUMNS):
+            raise ValueError(f"Invalid row: {row}")
+
+        value = row.get("Data_Value")
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or math.isinf(value):
+            raise ValueError(f"Invalid row: {row}")
+        if math.isnan(value):
+            continue
+
+        parsed_rows.append({column: row[column] for column in COLUMNS})
+    return parsed_rows
+
+def rows_to_frame(rows):
+    """
+    Build a dataframe with the dataset's column types from parsed rows
+    """
+    return pd.DataFrame(rows, columns=COLUMNS).astype(DTYPES)
+
+def append_rows(data, rows):
+    """
+    Get a dataset with the parsed rows appended to data
+    The categories of the categorical columns stay sorted, like when the CSV is read
+    """
+    frame = rows_to_frame(rows)
+    columns = {
+        column: union_categoricals([data[column], frame[column]], sort_categories=True)
+        for column in CATEGORICAL_COLUMNS
+    }
+    columns["Data_Value"] = pd.concat(
+        [data["Data_Value"], frame["Data_Value"]], ignore_index=True
+    ).to_numpy()
+    return pd.DataFrame(columns)
+
+class IngestionLog:
+    """
+    Thread-safe append-only log of the ingested rows, one JSON object per line
+    Each batch is flushed to disk before it is applied
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self._truncate_partial_line()
+
+    def _truncate_partial_line(self):
+        """
+        Remove a partially written last line, left by a crash during an append,
+        so that the next rows don't get appended to it
+        """
+        try:
+            with open(self.path, "rb+") as file:
+                content = file.read()
+                if content and not content.endswith(b"\n"):
+                    logger.error("Partial last line removed from ingestion log %s", self.path)
+                    file.truncate(content.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            pass
+
+    def append(self, rows):
+        """
+        Durably append parsed rows to the log
+        """
+        lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read(self, start = 0):
+        """
+        Read the rows of the log, skipping the first start lines
+        Returns the rows and the number of lines of the log
+        """
+        rows = []
+        with self.lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    lines = file.readlines()
+            except FileNotFoundError:
+                return rows, 0
+
+        for number, line in enumerate(lines[start:], start + 1):
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                logger.error("Invalid line %s in ingestion log %s", number, self.path)
+        return rows, len(lines)
+
+    def replay(self, data):
+        """
+        Append the logged rows to a dataset loaded from the CSV
+        Returns the dataset and the number of lines read from the log
+        """
+        rows, end = self.read()
+        if not rows:
+            return data, end
+
+        logger.info("Replaying %s rows from ingestion log %s", len(rows), self.path)
+        return append_rows(data, rows), end
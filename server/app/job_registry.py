@@ -0,0 +1,156 @@
+"""
+Module that contains the registry of the submitted jobs
+"""
+
+import time
+from collections import Counter, OrderedDict
+from threading import Lock
+
+class JobRegistry:
+    """
+    Thread-safe registry that allocates the job ids and keeps the status of each job
+    along with the time it reached each stage (accepted, dequeued, computed, serialized
+    and stored). The number of jobs with each status is updated incrementally, and
+    finished jobs are evicted ttl seconds after they finish (along with their result,
+    via on_evict)
+    """
+    def __init__(self, ttl, on_evict = None):
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+        self.next_job_id = 1
+        # Status of each job, in the order of the job ids
+        self.statuses = {}
+        # Monotonic time each job reached each stage at
+        self.timings = {}
+        self.counts = Counter()
+        # Time each finished job finished at, in the order they finished
+        self.finished = OrderedDict()
+        self.lock = Lock()
+
+    def _evict(self):
+        """
+        Evict the finished jobs whose TTL has passed
+        Must be called with the lock held, returns the evicted job ids
+        """
+        if self.ttl <= 0:
+            return []
+
+        evicted = []
+        expiration = time.monotonic() - self.ttl
+        while self.finished:
+            job_id, finish_time = next(iter(self.finished.items()))
+            if finish_time > expiration:
+                break
+
+            del self.finished[job_id]
+            self.counts[self.statuses.pop(job_id)] -= 1
+            self.timings.pop(job_id, None)
+            evicted.append(job_id)
+        return evicted
+
+    def _notify_evicted(self, evicted):
+        """
+        Call on_evict for the evicted jobs, outside the lock
+        """
+        if self.on_evict is not None:
+            for job_id in evicted:
+                self.on_evict(job_id)
+
+    def new_job(self):
+        """
+        Allocate the id of a new job, registered with the running status
+        """
+        with self.lock:
+            evicted = self._evict()
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.statuses[job_id] = "running"
+            self.timings[job_id] = {"accepted": time.monotonic()}
+            self.counts["running"] += 1
+
+        self._notify_evicted(evicted)
+        return job_id
+
+    def set_status(self, job_id, status):
+        """
+        Change the status of a job
+        """
+        with self.lock:
+            evicted = self._evict()
+            old_status = self.statuses.get(job_id)
+            if old_status is not None:
+                self.counts[old_status] -= 1
+                self.statuses[job_id] = status
+                self.counts[status] += 1
+
+                if status != "running":
+                    self.finished[job_id] = time.monotonic()
+                    self.finished.move_to_end(job_id)
+
+        self._notify_evicted(evicted)
+
+    def record(self, job_id, stage):
+        """
+        Record the time a job reached a stage at
+        """
+        now = time.monotonic()
+        with self.lock:
+            timings = self.timings.get(job_id)
+            if timings is not None:
+                timings[stage] = now
+
+    def get_timings(self, job_id):
+        """
+        Get the number of seconds after it was accepted that a job reached each stage at,
+        or None if the job doesn't exist or was evicted
+        """
+        with self.lock:
+            timings = self.timings.get(job_id)
+            if timings is None:
+                return None
+
+            accepted = timings["accepted"]
+            return {stage: stage_time - accepted for stage, stage_time in timings.items()}
+
+    def get(self, job_id):
+        """
+        Get the status of a job, or None if the job doesn't exist or was evicted
+        """
+        return self.statuses.get(job_id)
+
+    def count(self, status):
+        """
+        Get the number of jobs with a status
+        """
+        with self.lock:
+            evicted = self._evict()
+            count = self.counts[status]
+
+        self._notify_evicted(evicted)
+        return count
+
+    def list(self, cursor = 0, limit = None, status = None):
+        """
+        List the (job_id, status) pairs of the jobs with ids greater than cursor,
+        optionally only those with a status, and at most limit of them
+        Returns the pairs and the cursor for the next page (None on the last page)
+        """
+        with self.lock:
+            evicted = self._evict()
+
+            jobs = []
+            next_cursor = None
+            first_job_id = next(iter(self.statuses), self.next_job_id)
+            for job_id in range(max(cursor + 1, first_job_id), self.next_job_id):
+                job_status = self.statuses.get(job_id)
+                if job_status is None or (status is not None and job_status != status):
+                    continue
+
+                if limit is not None and len(jobs) == limit:
+                    next_cursor = jobs[-1][0]
+                    break
+                jobs.append((job_id, job_status))
+
+        self._notify_evicted(evicted)
+        return jobs, next_cursor
@@ -0,0 +1,130 @@
+"""
+Module that contains the counters and histograms exposed by /api/metrics,
+rendered in the Prometheus text exposition format
+"""
+
+import bisect
+from threading import Lock
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+def _escape(value):
+    """
+    Escape a label value for the exposition format
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_value(value):
+    """
+    Format a sample value for the exposition format
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_sample(name, value, labels = None):
+    """
+    Format a single sample line
+    """
+    if not labels:
+        return f"{name} {_format_value(value)}"
+
+    label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+    return f"{name}{{{label_text}}} {_format_value(value)}"
+
+def format_metric(name, metric_type, documentation, samples):
+    """
+    Format a metric family, given its samples as (labels, value) pairs
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    lines += [format_sample(name, value, labels) for labels, value in samples]
+    return lines
+
+class Counter:
+    """
+    Thread-safe family of counters, one for each combination of label values
+    """
+    def __init__(self, name, documentation, label_names = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount = 1):
+        """
+        Increment the counter with the given label values
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        """
+        Get the lines of the counter family
+        """
+        with self.lock:
+            values = list(self.values.items())
+
+        return format_metric(self.name, "counter", self.documentation, [
+            (dict(zip(self.label_names, label_values)), value)
+            for label_values, value in sorted(values)
+        ])
+
+class Histogram:
+    """
+    Thread-safe family of histograms, one for each combination of label values
+    Each histogram keeps a count per bucket (not cumulative) along with the sum
+    and the number of the observed values
+    """
+    def __init__(self, name, documentation, label_names = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts (the last one for +Inf), sum, count]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Record a value in the histogram with the given label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.values.get(label_values)
+            if histogram is None:
+                histogram = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def collect(self):
+        """
+        Get the lines of the histogram family
+        """
+        with self.lock:
+            values = [
+                (label_values, list(counts), total, count)
+                for label_values, (counts, total, count) in self.values.items()
+            ]
+
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, counts, total, count in sorted(values):
+            labels = dict(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(format_sample(
+                    f"{self.name}_bucket", cumulative, labels | {"le": _format_value(bound)}
+                ))
+            lines.append(format_sample(f"{self.name}_sum", total, labels))
+            lines.append(format_sample(f"{self.name}_count", count, labels))
+        return lines
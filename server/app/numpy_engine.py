@@ -0,0 +1,195 @@
+"""
+Module that contains the vectorized NumPy solver engine
+"""
+
+import numpy as np
+import pandas as pd
+
+def _encode(column):
+    """
+    Encode a column as integer codes (-1 for missing values) and its unique labels
+    """
+    codes, labels = pd.factorize(column)
+    return codes.astype(np.int64), list(labels)
+
+def _ranks(labels):
+    """
+    Compute the position of every label in the sorted order of the labels
+    """
+    ranks = np.empty(len(labels), dtype=np.int64)
+    ranks[sorted(range(len(labels)), key=labels.__getitem__)] = np.arange(len(labels))
+    return ranks
+
+class NumpyEngine:
+    """
+    Class that answers the base queries using integer-coded columns
+    The columns are encoded once and the rows are sorted by question, so that
+    the rows of a question are a contiguous slice of the encoded arrays
+    The means of the groups of states and of subcategories are computed once, for all
+    the questions, and the grouped requests only select and sort them
+    """
+    def __init__(self, data):
+        question_codes, questions = _encode(data["Question"])
+        state_codes, self.states = _encode(data["LocationDesc"])
+        values = data["Data_Value"].to_numpy(dtype=np.float64, na_value=np.nan)
+
+        if "StratificationCategory1" in data and "Stratification1" in data:
+            category_codes, categories = _encode(data["StratificationCategory1"])
+            stratification_codes, stratifications = _encode(data["Stratification1"])
+        else:
+            category_codes = stratification_codes = np.full(len(data), -1, dtype=np.int64)
+            categories, stratifications = [], []
+
+        # Encode each (category, stratification) pair as a single code
+        pairs = np.where(
+            (category_codes >= 0) & (stratification_codes >= 0),
+            category_codes * max(len(stratifications), 1) + stratification_codes,
+            -1,
+        )
+        pair_codes, pair_labels = _encode(pd.Series(pairs).where(pairs >= 0))
+        self.pairs = [
+            (categories[int(label) // len(stratifications)],
+             stratifications[int(label) % len(stratifications)])
+            for label in pair_labels
+        ]
+
+        # Sort the rows by question and keep the bounds of each question's slice
+        order = np.argsort(question_codes, kind="stable")
+        question_codes = question_codes[order]
+        self.question_bounds = {
+            question: (
+                np.searchsorted(question_codes, code, side="left"),
+                np.searchsorted(question_codes, code, side="right"),
+            )
+            for code, question in enumerate(questions)
+        }
+
+        self.state_codes = state_codes[order]
+        pair_codes = pair_codes[order]
+        valid = ~np.isnan(values[order])
+        self.valid = valid.astype(np.float64)
+        self.values = np.where(valid, values[order], 0.0)
+
+        # Mean of every (question, state) and (question, state, pair) group, by question
+        self.question_index = {question: code for code, question in enumerate(questions)}
+        kept = self.state_codes >= 0
+        means, present = self._grouped_means(
+            question_codes[kept] * len(self.states) + self.state_codes[kept],
+            self.values[kept], self.valid[kept], len(questions) * len(self.states),
+        )
+        self.state_means = means.reshape(len(questions), len(self.states))
+        self.state_present = present.reshape(len(questions), len(self.states))
+
+        kept &= pair_codes >= 0
+        means, present = self._grouped_means(
+            (question_codes[kept] * len(self.states) + self.state_codes[kept])
+            * len(self.pairs) + pair_codes[kept],
+            self.values[kept], self.valid[kept],
+            len(questions) * len(self.states) * len(self.pairs),
+        )
+        self.category_means = means.reshape(len(questions), -1)
+        self.category_present = present.reshape(len(questions), -1)
+
+        self.state_index = {state: code for code, state in enumerate(self.states)}
+        self.state_ranks = _ranks(self.states)
+        self.pair_ranks = _ranks(self.pairs)
+
+        # (state, pair) group codes sorted by state then by pair, and their keys
+        codes = np.arange(len(self.states) * len(self.pairs))
+        states, pairs = np.divmod(codes, max(len(self.pairs), 1))
+        self.category_order = codes[np.lexsort((self.pair_ranks[pairs], self.state_ranks[states]))]
+        self.category_keys = [
+            str((self.states[code // len(self.pairs)], *self.pairs[code % len(self.pairs)]))
+            for code in codes
+        ]
+        self.pair_keys = [str(pair) for pair in self.pairs]
+
+    def _slice(self, question):
+        """
+        Get the slice of rows for a question
+        """
+        start, end = self.question_bounds.get(question, (0, 0))
+        return slice(start, end)
+
+    @staticmethod
+    def _grouped_means(codes, values, valid, size):
+        """
+        Compute the mean of the valid values for every group code, along with
+        a mask of the groups that have at least one row
+        The groups are reduced by the grouped mean of pandas, which sums the values of
+        each group in the order of the rows with a compensated sum, so that the means
+        are exactly the ones of the pandas engine. Only called when the engine is built
+        """
+        grouped = pd.Series(np.where(valid > 0, values, np.nan)).groupby(
+            codes, sort=False
+        ).mean()
+        groups = grouped.index.to_numpy()
+        means = np.full(size, np.nan)
+        means[groups] = grouped.to_numpy()
+        present = np.zeros(size, dtype=bool)
+        present[groups] = True
+        return means, present
+
+    def states_mean(self, question):
+        """
+        Average value for a question for each state, sorted by value
+        """
+        code = self.question_index.get(question)
+        if code is None:
+            return {}
+        means, present = self.state_means[code], self.state_present[code]
+
+        codes = np.flatnonzero(present)
+        codes = codes[np.argsort(self.state_ranks[codes], kind="stable")]
+        codes = codes[np.argsort(means[codes], kind="stable")]
+        return {self.states[code]: float(means[code]) for code in codes}
+
+    def state_mean(self, question, state):
+        """
+        Average value for a question for a specific state
+        """
+        rows = self._slice(question)
+        selected = self.state_codes[rows] == self.state_index.get(state, -2)
+        count = self.valid[rows][selected].sum()
+        if count == 0:
+            return {state: np.nan}
+        return {state: float(self.values[rows][selected].sum() / count)}
+
+    def global_mean(self, question):
+        """
+        Global average value for a question
+        """
+        rows = self._slice(question)
+        count = self.valid[rows].sum()
+        if count == 0:
+            return {"global_mean": np.nan}
+        return {"global_mean": float(self.values[rows].sum() / count)}
+
+    def mean_by_category(self, question):
+        """
+        Average value for a question for each state and each subcategory in a category
+        """
+        code = self.question_index.get(question)
+        if code is None:
+            return {}
+        means, present = self.category_means[code], self.category_present[code]
+
+        codes = self.category_order[present[self.category_order]]
+        return {self.category_keys[code]: float(means[code]) for code in codes.tolist()}
+
+    def state_mean_by_category(self, question, state):
+        """
+        Average value for a question for a specific state and each subcategory in a category
+        """
+        code = self.question_index.get(question)
+        state_code = self.state_index.get(state)
+        if code is None or state_code is None:
+            return {state: {}}
+        # The pairs of the state are a contiguous slice of the question's groups
+        groups = slice(state_code * len(self.pairs), (state_code + 1) * len(self.pairs))
+        means = self.category_means[code][groups]
+        present = self.category_present[code][groups]
+
+        codes = np.flatnonzero(present)
+        codes = codes[np.argsort(self.pair_ranks[codes], kind="stable")]
+        return {state: {self.pair_keys[code]: float(means[code]) for code in codes}}
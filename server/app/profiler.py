@@ -0,0 +1,67 @@
+"""
+Module that contains the sampling profiler of the solver
+"""
+
+import cProfile
+import io
+import pstats
+import random
+from threading import Lock
+
+class SamplingProfiler:
+    """
+    Thread-safe profiler that runs cProfile on a fraction of the calls and keeps
+    the aggregated stats of the profiled calls for each name
+    Only one call is profiled at a time, since only one profiler can be active
+    in the process on recent Python versions
+    """
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        # name -> [aggregated pstats.Stats, number of profiled calls]
+        self.stats = {}
+        self.stats_lock = Lock()
+        self.profiling_lock = Lock()
+
+    def run(self, name, function, *args):
+        """
+        Call function with args, profiling the call if it is sampled
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return function(*args)
+
+        if not self.profiling_lock.acquire(blocking=False):
+            # Another call is being profiled
+            return function(*args)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self.profiling_lock.release()
+            with self.stats_lock:
+                if name in self.stats:
+                    self.stats[name][0].add(profile)
+                    self.stats[name][1] += 1
+                else:
+                    self.stats[name] = [pstats.Stats(profile), 1]
+
+    def report(self, limit = 20, sort = "cumulative"):
+        """
+        Get, for each name, the number of profiled calls and the text of the
+        aggregated stats of the limit most expensive functions
+        """
+        with self.stats_lock:
+            report = {}
+            for name, (stats, calls) in sorted(self.stats.items()):
+                stream = io.StringIO()
+                stats.stream = stream
+                stats.sort_stats(sort).print_stats(limit)
+                report[name] = {"profiled_calls": calls, "stats": stream.getvalue()}
+            return report
+
+    def reset(self):
+        """
+        Forget the aggregated stats
+        """
+        with self.stats_lock:
+            self.stats = {}
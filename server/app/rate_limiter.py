@@ -0,0 +1,57 @@
+"""
+Module that contains the per-client rate limiter
+"""
+
+import math
+import time
+from threading import Lock
+
+# Number of clients tracked before the idle ones are forgotten
+MAX_TRACKED_CLIENTS = 10000
+
+class RateLimiter:
+    """
+    Thread-safe token bucket rate limiter, with one bucket for each client
+    Each client can make rate requests per second on average, in bursts of at most burst
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # client -> [available tokens, time of the last update]
+        self.buckets = {}
+        self.rejected = 0
+        self.lock = Lock()
+
+    def _forget_idle_clients(self, now):
+        """
+        Forget the clients whose bucket is full again
+        Must be called with the lock held
+        """
+        self.buckets = {
+            client: bucket for client, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+
+    def acquire(self, client):
+        """
+        Take a token from the bucket of a client
+        Returns 0 if the request is allowed, otherwise the number of seconds
+        after which the client should retry
+        """
+        if self.rate <= 0:
+            return 0
+
+        now = time.monotonic()
+        with self.lock:
+            if client not in self.buckets and len(self.buckets) >= MAX_TRACKED_CLIENTS:
+                self._forget_idle_clients(now)
+
+            tokens, last_update = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last_update) * self.rate)
+            if tokens < 1:
+                self.buckets[client] = [tokens, now]
+                self.rejected += 1
+                return max(1, math.ceil((1 - tokens) / self.rate))
+
+            self.buckets[client] = [tokens - 1, now]
+            return 0
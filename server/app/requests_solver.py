@@ -1,17 +1,49 @@
 """
 Helper functions to solve the POST requests made to the webserver
+
+The helpers accept either the raw dataframe or an engine (AggregateIndex,
+NumpyEngine) that answers the base queries directly
 """
 
 import os
 import json
+from threading import Event, Lock
+
+import pandas as pd
 from app import constants
+from app.aggregate_index import AggregateIndex
+from app.metrics import Counter
+from app.numpy_engine import NumpyEngine
+from app.profiler import SamplingProfiler
+from app.result_cache import ResultCache
+
+# Engines that can be selected through the SOLVER_ENGINE environment variable
+ENGINES = {
+    "index": AggregateIndex,
+    "numpy": NumpyEngine,
+    "pandas": lambda data: data,
+}
+
+def create_engine(name, data):
+    """
+    Create the engine used by the helpers to answer the requests:
+    - index: precomputed sums and counts for every group (default)
+    - numpy: integer-coded columns, sliced by question and reduced on every request
+    - pandas: the raw dataframe, filtered and grouped on every request
+    """
+    if name not in ENGINES:
+        raise ValueError(f"Unknown solver engine: {name}")
+    return ENGINES[name](data)
 
 def states_mean(data, question):
     """
     Compute the average value for a question for each state
     """
+    if not isinstance(data, pd.DataFrame):
+        return data.states_mean(question)
+
     filtered_data = data[data["Question"] == question]
-    state_avg = filtered_data.groupby("LocationDesc")["Data_Value"].mean()
+    state_avg = filtered_data.groupby("LocationDesc", observed=True)["Data_Value"].mean()
     state_avg_sorted = state_avg.sort_values()
     return state_avg_sorted.to_dict()
 
@@ -19,6 +51,9 @@ def state_mean(data, question, state):
     """
     Compute the average value for a question for a specific state
     """
+    if not isinstance(data, pd.DataFrame):
+        return data.state_mean(question, state)
+
     filtered_data = data[(data["Question"] == question) & (data["LocationDesc"] == state)]
     state_avg = filtered_data["Data_Value"].mean()
     return {state: state_avg}
@@ -47,6 +82,9 @@ def global_mean(data, question):
     """
     Compute the global average value for a question
     """
+    if not isinstance(data, pd.DataFrame):
+        return data.global_mean(question)
+
     filtered_data = data[data["Question"] == question]
     global_avg = filtered_data["Data_Value"].mean()
     return {"global_mean": global_avg}
@@ -72,9 +110,12 @@ def mean_by_category(data, question):
     """
     Compute the average value for a question for each state and each subcategory in a category
     """
+    if not isinstance(data, pd.DataFrame):
+        return data.mean_by_category(question)
+
     filtered_data = data[data["Question"] == question]
     states_categories_avg = filtered_data.groupby(
-        ["LocationDesc", "StratificationCategory1", "Stratification1"]
+        ["LocationDesc", "StratificationCategory1", "Stratification1"], observed=True
     )["Data_Value"].mean()
     return {str(key): value for key, value in states_categories_avg.to_dict().items()}
 
@@ -82,12 +123,62 @@ def state_mean_by_category(data, question, state):
     """
     Compute the average value for a question for a specific state and each subcategory in a category
     """
+    if not isinstance(data, pd.DataFrame):
+        return data.state_mean_by_category(question, state)
+
     filtered_data = data[(data["Question"] == question) & (data["LocationDesc"] == state)]
     states_categories_avg = filtered_data.groupby(
-        ["StratificationCategory1", "Stratification1"]
+        ["StratificationCategory1", "Stratification1"], observed=True
     )["Data_Value"].mean()
     return {state: {str(key): value for key, value in states_categories_avg.to_dict().items()}}
 
+# Endpoint functions that can be used in a batch and whether they require a state
+ENDPOINTS = {
+    "states_mean": (states_mean, False),
+    "state_mean": (state_mean, True),
+    "best5": (best5, False),
+    "worst5": (worst5, False),
+    "global_mean": (global_mean, False),
+    "diff_from_mean": (diff_from_mean, False),
+    "state_diff_from_mean": (state_diff_from_mean, True),
+    "mean_by_category": (mean_by_category, False),
+    "state_mean_by_category": (state_mean_by_category, True),
+}
+
+# Maximum number of items in a batch
+MAX_BATCH_ITEMS = 1000
+
+def batch(data, items):
+    """
+    Compute the answers for a list of (endpoint, arguments) items, where the arguments
+    are None for an invalid item. The items are grouped by question, so that the rows
+    of each question are filtered and grouped only once for all its items
+    """
+    positions_by_question = {}
+    for position, (_, args) in enumerate(items):
+        if args is not None:
+            positions_by_question.setdefault(args[0], []).append(position)
+
+    answers = [{"error_message": "Invalid input"}] * len(items)
+    for question, positions in positions_by_question.items():
+        source = data
+        if isinstance(data, pd.DataFrame):
+            source = AggregateIndex(data[data["Question"] == question])
+
+        for position in positions:
+            name, args = items[position]
+            answers[position] = ENDPOINTS[name][0](source, *args)
+
+    return [
+        {
+            "endpoint": name,
+            "question": args[0] if args is not None else None,
+            "state": args[1] if args is not None and len(args) > 1 else None,
+            "data": answer,
+        }
+        for (name, args), answer in zip(items, answers)
+    ]
+
 class RequestsSolver:
     """
     Helper class to solve the POST requests made to the webserver
@@ -95,40 +186,177 @@ class RequestsSolver:
     def __init__(self, webserver):
         self.webserver = webserver
 
+        # Check if environment variables SOLVER_CACHE_SIZE, SOLVER_CACHE_MAX_BYTES and
+        # SOLVER_CACHE_MAX_ENTRY_BYTES are defined
+        # If they are not, keep the results of the last 1024 distinct requests within 64MB,
+        # leaving out the results over 1MB (the ones the result store spills to disk)
+        self.cache = ResultCache(
+            int(os.getenv("SOLVER_CACHE_SIZE", "1024")),
+            int(os.getenv("SOLVER_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            int(os.getenv("SOLVER_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024))),
+        )
+
+        # Events set when a job finishes, created for the jobs someone is waiting for
+        self.completion_events = {}
+        self.completion_events_lock = Lock()
+
+        # Check if environment variable PROFILE_SAMPLE_RATE is defined
+        # If it is, that fraction of the solver calls is profiled with cProfile
+        self.profiler = SamplingProfiler(float(os.getenv("PROFILE_SAMPLE_RATE", "0")))
+
+        # Results solved for the jobs, exposed by /api/metrics
+        self.solved_requests = Counter(
+            "webserver_solver_results_total",
+            "Requests solved by the solver, by endpoint function and status",
+            ("endpoint", "status"),
+        )
+
     def write_result(self, result, job_id, status = "done"):
         """
         Given the result in the form of a dictionary and the status for the processed action,
-        write them to a JSON file named after the job_id
+        encode the result as JSON bytes once and keep it in the result store
+        Returns the encoded result
         """
-        os.makedirs("results", exist_ok=True)
-        with open(f"results/job_id_{job_id}.json", "w", encoding="utf-8") as file:
-            file.write(json.dumps(result))
+        encoded_result = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        self.webserver.jobs.record(job_id, "serialized")
+        self.store_result(encoded_result, job_id, status)
+        return encoded_result
 
-        self.webserver.job_status[job_id] = status
+    def store_result(self, encoded_result, job_id, status = "done"):
+        """
+        Keep an already encoded result in the result store and update the status of the job
+        """
+        self.webserver.result_store.put(job_id, encoded_result)
+        self.webserver.jobs.record(job_id, "stored")
 
-    def solver(self, endpoint, job_id, request_args, has_state = False):
+        self.webserver.jobs.set_status(job_id, status)
+
+        # Wake up the requests waiting for the job
+        with self.completion_events_lock:
+            event = self.completion_events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def wait_for_job(self, job_id, timeout):
         """
-        Helper function for the requests that require a question and a state as input
-        Checks the validity of the input and delegates the computation to the endpoint function
+        Wait at most timeout seconds for a running job to finish
+        Returns the status of the job
         """
-        result = {}
+        with self.completion_events_lock:
+            event = self.completion_events.setdefault(job_id, Event())
+
+        # The status is checked after the event is registered, so a job finishing
+        # meanwhile either is seen here or sets the event
+        if self.webserver.jobs.get(job_id) == "running":
+            event.wait(timeout)
+
+        status = self.webserver.jobs.get(job_id)
+        if status != "running":
+            with self.completion_events_lock:
+                self.completion_events.pop(job_id, None)
+        return status
+
+    @staticmethod
+    def parse_args(request_args, has_state = False):
+        """
+        Check the validity of the input and return the arguments for the endpoint function
+        (the question and, if needed, the state) or None if the input is invalid
+        """
+        if not isinstance(request_args, dict):
+            return None
 
         if ("question" not in request_args.keys()) or (
             request_args["question"] not in constants.QUESTIONS):
-            self.write_result({"error_message": "Invalid input"}, job_id, "error")
-            return
+            return None
         question = request_args["question"]
 
         if has_state is True:
             if ("state" not in request_args.keys()) or (
                 request_args["state"] not in constants.STATES):
-                self.write_result({"error_message": "Invalid input"}, job_id, "error")
-                return
+                return None
+
+            return (question, request_args["state"])
+
+        return (question,)
+
+    @staticmethod
+    def parse_batch(request_args):
+        """
+        Check the validity of a batch, given as a list of {endpoint, question, state}
+        items or as {"items": [...]}, and return the arguments for the batch function
+        or None if the batch is invalid. Invalid items are kept, without arguments
+        """
+        items = request_args.get("items") if isinstance(request_args, dict) else request_args
+        if not isinstance(items, list) or len(items) > MAX_BATCH_ITEMS:
+            return None
+
+        parsed_items = []
+        for item in items:
+            name = item.get("endpoint") if isinstance(item, dict) else None
+            if not isinstance(name, str) or name not in ENDPOINTS:
+                parsed_items.append((None, None))
+                continue
+
+            parsed_items.append((name, RequestsSolver.parse_args(item, ENDPOINTS[name][1])))
+
+        return (tuple(parsed_items),)
+
+    def parse_request(self, endpoint, request_args, has_state = False):
+        """
+        Check the validity of the input for an endpoint function or for a batch
+        """
+        if endpoint is batch:
+            return self.parse_batch(request_args)
+        return self.parse_args(request_args, has_state)
 
-            state = request_args["state"]
+    def request_key(self, endpoint, request_args, has_state = False):
+        """
+        Get the key that identifies identical requests: the endpoint function
+        and the validated arguments, or None if the input is invalid
+        """
+        args = self.parse_request(endpoint, request_args, has_state)
+        if args is None:
+            return None
+        return (endpoint, args)
+
+    def solve_from_cache(self, key, job_id):
+        """
+        Complete the job right away if the result for the same request is cached
+        Returns whether the job was completed
+        """
+        encoded_result = self.cache.get(key, self.webserver.solver_engine)
+        if encoded_result is None:
+            return False
+
+        self.store_result(encoded_result, job_id)
+        return True
+
+    def solver(self, endpoint, job_id, request_args, has_state = False):
+        """
+        Helper function for the requests that require a question and a state as input
+        Checks the validity of the input and delegates the computation to the endpoint function
+        Returns the encoded result and the status of the job
+        A sample of the calls is profiled, with the stats aggregated by endpoint
+        """
+        return self.profiler.run(
+            endpoint.__name__, self.solve, endpoint, job_id, request_args, has_state
+        )
+
+    def solve(self, endpoint, job_id, request_args, has_state):
+        """
+        Check the validity of the input, compute the result and keep it in the result store
+        """
+        args = self.parse_request(endpoint, request_args, has_state)
+        if args is None:
+            self.solved_requests.inc(endpoint.__name__, "error")
+            return self.write_result({"error_message": "Invalid input"}, job_id, "error"), "error"
 
-            result = endpoint(self.webserver.data, question, state)
-        else:
-            result = endpoint(self.webserver.data, question)
+        engine = self.webserver.solver_engine
+        result = self.webserver.tasks_runner.compute(endpoint, engine, args)
+        self.webserver.jobs.record(job_id, "computed")
+        encoded_result = self.write_result(result, job_id)
+        # The result is cached already encoded, so that the hits are not serialized again
+        self.cache.put((endpoint, args), encoded_result, engine)
+        self.solved_requests.inc(endpoint.__name__, "done")
 
-        self.write_result(result, job_id)
+        return encoded_result, "done"
@@ -0,0 +1,91 @@
+"""
+Module that contains the memoization cache for the results of the requests
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+class ResultCache:
+    """
+    Thread-safe LRU cache that maps an (endpoint, arguments) key to the encoded result
+    of the request
+    The cache is tied to the engine the results were computed from and is
+    cleared automatically whenever a different engine is used
+    It keeps at most max_size entries and max_bytes bytes of results, and doesn't keep
+    the results larger than max_entry_bytes (0 means no limit for both)
+    """
+    def __init__(self, max_size, max_bytes = 0, max_entry_bytes = 0):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.source = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def _check_source(self, source):
+        """
+        Drop all the entries if they were computed from a different engine
+        Must be called with the lock held
+        """
+        if source is not self.source:
+            self.entries.clear()
+            self.bytes_used = 0
+            self.source = source
+
+    def get(self, key, source):
+        """
+        Get the cached result for a key, or None if it is not cached
+        """
+        with self.lock:
+            self._check_source(source)
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result, source):
+        """
+        Cache the result for a key, evicting the least recently used entries if the cache
+        is full
+        Results too large to be cached are left out, so that a few large results (such as
+        batches) don't hold the memory the result store avoids holding
+        """
+        if self.max_size <= 0:
+            return
+        if 0 < self.max_entry_bytes < len(result) or 0 < self.max_bytes < len(result):
+            return
+
+        with self.lock:
+            # The result was computed from an engine that has been replaced meanwhile
+            if source is not self.source:
+                return
+
+            old_result = self.entries.pop(key, None)
+            if old_result is not None:
+                self.bytes_used -= len(old_result)
+            self.entries[key] = result
+            self.bytes_used += len(result)
+            while len(self.entries) > self.max_size or 0 < self.max_bytes < self.bytes_used:
+                _, old_result = self.entries.popitem(last=False)
+                self.bytes_used -= len(old_result)
+
+    def stats(self):
+        """
+        Get the size of the cache and the hit/miss counters
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "bytes": self.bytes_used,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,219 @@
+"""
+Module that contains the stores that keep the results of the jobs
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class DiskResultStore:
+    """
+    Class that keeps each result in a JSON file named after the job_id
+    """
+    def __init__(self, directory = "results"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        """
+        Get the path of the file for a job
+        """
+        return os.path.join(self.directory, f"job_id_{job_id}.json")
+
+    def put(self, job_id, result):
+        """
+        Write the encoded result of a job to its file
+        """
+        with open(self._path(job_id), "wb") as file:
+            file.write(result)
+
+    def get(self, job_id):
+        """
+        Read the encoded result of a job, or None if there is no result for it
+        """
+        try:
+            with open(self._path(job_id), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, job_id):
+        """
+        Remove the result of a job
+        """
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """
+        Get the number of results kept by the store
+        """
+        return {"backend": "disk", "results": len(os.listdir(self.directory))}
+
+class MemoryResultStore:
+    """
+    Class that keeps the encoded results in memory, within a memory budget
+    Results larger than spill_size, and the oldest results once the budget is exceeded,
+    are spilled to the spill store (if any). Without a spill store, the results are
+    evicted instead once the budget is exceeded: the collected ones first, in the order
+    they were collected, then the oldest ones. A result is dropped ttl seconds after
+    it is first collected
+    """
+    def __init__(self, memory_budget, ttl, spill_size = 0, spill_store = None):
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.spill_size = spill_size
+        self.spill_store = spill_store
+
+        # Results kept in memory, oldest first
+        self.results = OrderedDict()
+        self.memory_used = 0
+        # Job ids of the results that were spilled to disk
+        self.spilled = set()
+        # Job ids of the results kept in memory that were collected, in collection order
+        self.collected = OrderedDict()
+        self.evicted = 0
+        # Expiration time for the collected results, earliest first
+        self.expirations = OrderedDict()
+        self.lock = Lock()
+
+    def _expire(self):
+        """
+        Drop the collected results whose TTL has passed
+        Must be called with the lock held
+        """
+        now = time.monotonic()
+        while self.expirations:
+            job_id, expiration = next(iter(self.expirations.items()))
+            if expiration > now:
+                break
+
+            del self.expirations[job_id]
+            self._drop(job_id)
+
+    def _drop(self, job_id):
+        """
+        Remove a result from memory or from the spill store
+        Must be called with the lock held
+        """
+        self.collected.pop(job_id, None)
+        result = self.results.pop(job_id, None)
+        if result is not None:
+            self.memory_used -= len(result)
+        elif job_id in self.spilled:
+            self.spilled.remove(job_id)
+            self.spill_store.delete(job_id)
+
+    def put(self, job_id, result):
+        """
+        Keep the encoded result of a job
+        """
+        with self.lock:
+            self._expire()
+
+            if self.spill_store is not None and len(result) > self.spill_size:
+                self.spill_store.put(job_id, result)
+                self.spilled.add(job_id)
+                return
+
+            self.results[job_id] = result
+            self.memory_used += len(result)
+
+            # Spill the oldest results until the memory budget is respected
+            while (self.spill_store is not None and self.memory_used > self.memory_budget
+                   and self.results):
+                old_job_id, old_result = self.results.popitem(last=False)
+                self.memory_used -= len(old_result)
+                self.spill_store.put(old_job_id, old_result)
+                self.spilled.add(old_job_id)
+                self.collected.pop(old_job_id, None)
+
+            if self.spill_store is None:
+                self._evict()
+
+    def _evict(self):
+        """
+        Drop results from memory until the memory budget is respected, the collected
+        ones first
+        Must be called with the lock held
+        """
+        while self.memory_used > self.memory_budget and self.results:
+            if self.collected:
+                job_id = next(iter(self.collected))
+            else:
+                job_id = next(iter(self.results))
+            self.expirations.pop(job_id, None)
+            self._drop(job_id)
+            self.evicted += 1
+
+    def get(self, job_id):
+        """
+        Get the encoded result of a job, or None if there is no result for it
+        The first call starts the TTL of the result
+        """
+        with self.lock:
+            self._expire()
+
+            if job_id in self.results:
+                result = self.results[job_id]
+                self.collected.setdefault(job_id)
+            elif job_id in self.spilled:
+                result = self.spill_store.get(job_id)
+            else:
+                return None
+
+            if self.ttl > 0 and job_id not in self.expirations:
+                self.expirations[job_id] = time.monotonic() + self.ttl
+
+            return result
+
+    def delete(self, job_id):
+        """
+        Remove the result of a job
+        """
+        with self.lock:
+            self.expirations.pop(job_id, None)
+            self._drop(job_id)
+
+    def stats(self):
+        """
+        Get the number of results and the memory used by the store
+        """
+        with self.lock:
+            self._expire()
+            return {
+                "backend": "memory",
+                "results": len(self.results) + len(self.spilled),
+                "spilled": len(self.spilled),
+                "evicted": self.evicted,
+                "memory_used": self.memory_used,
+                "memory_budget": self.memory_budget,
+            }
+
+def create_result_store():
+    """
+    Create the result store configured through the environment variables:
+    - RESULT_STORE: memory (default) or disk
+    - RESULT_STORE_MEMORY_BUDGET: bytes of results kept in memory (default 64MB)
+    - RESULT_STORE_SPILL_SIZE: results larger than this many bytes are written
+      to disk (default 1MB, 0 disables spilling to disk, and the results over
+      the memory budget are then evicted)
+    - RESULT_STORE_TTL: seconds a result is kept after it is first collected
+      (default 300, 0 keeps the results forever)
+    """
+    backend = os.getenv("RESULT_STORE", "memory")
+    if backend == "disk":
+        return DiskResultStore()
+    if backend != "memory":
+        raise ValueError(f"Unknown result store: {backend}")
+
+    spill_size = int(os.getenv("RESULT_STORE_SPILL_SIZE", str(1024 * 1024)))
+    return MemoryResultStore(
+        memory_budget=int(os.getenv("RESULT_STORE_MEMORY_BUDGET", str(64 * 1024 * 1024))),
+        ttl=float(os.getenv("RESULT_STORE_TTL", "300")),
+        spill_size=spill_size,
+        spill_store=DiskResultStore() if spill_size > 0 else None,
+    )
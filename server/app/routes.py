@@ -2,29 +2,92 @@
 Module that contains routes for the webserver
 """
 import json
+import time
 
-from flask import request, jsonify
+from flask import Response, g, request, jsonify
 from app import webserver, requests_solver
+from app.dataset import memory_report
+from app.ingestion import parse_rows
+from app.metrics import format_metric
+
+# Maximum number of seconds a request can wait for its job to finish
+MAX_SYNC_WAIT = 10
+
+@webserver.before_request
+def start_request_timer():
+    """
+    Record the time the request started being served at
+    """
+    g.request_start_time = time.perf_counter()
+
+@webserver.after_request
+def count_request(response):
+    """
+    Count the request and the time it took to serve it, by route
+    """
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    webserver.http_requests.inc(route, request.method, str(response.status_code))
+    if "request_start_time" in g:
+        webserver.http_request_seconds.observe(
+            time.perf_counter() - g.request_start_time, route
+        )
+    return response
+
+@webserver.after_request
+def log_first_request(response):
+    """
+    Log the time from startup until the first request was served
+    """
+    if not webserver.first_request_served:
+        webserver.first_request_served = True
+        webserver.logger.info(
+            "First request served %.3fs after startup",
+            time.perf_counter() - webserver.start_time
+        )
+    return response
 
 def submit_request(endpoint, req, has_state = False):
     """
     Submit a post request to the thread pool
     """
     if request.method == 'POST':
+        # Reject the request if the client made too many requests or the queue is full
+        retry_after = webserver.rate_limiter.acquire(req.remote_addr)
+        if retry_after:
+            webserver.logger.error("Rate limit exceeded by %s", req.remote_addr)
+            webserver.job_requests.inc(endpoint.__name__, "rate_limited")
+            return (jsonify({"status": "error", "reason": "Too many requests"}), 429,
+                    {"Retry-After": str(retry_after)})
+
+        if webserver.tasks_runner.is_saturated():
+            webserver.logger.error("Job queue is full")
+            webserver.job_requests.inc(endpoint.__name__, "saturated")
+            return (jsonify({"status": "error", "reason": "Server busy"}), 503,
+                    {"Retry-After": str(webserver.tasks_runner.retry_after())})
+
         # Get request data
         data = req.json
-        webserver.logger.info("Request data: %s", data)
+        webserver.logger.info("Request data: %s", webserver.log_payload(data))
 
-        # Assign a job id
-        job_id = webserver.job_counter
+        # Assign a job id, registered with the running status
+        job_id = webserver.jobs.new_job()
         webserver.logger.info("Job id assigned: %s", job_id)
+        webserver.job_requests.inc(endpoint.__name__, "accepted")
 
         # Register the job to the thread pool. Don't wait for task to finish
-        webserver.job_status[job_id] = "running"
+        # unless the client asked for a synchronous response
         webserver.tasks_runner.submit( endpoint, job_id, data, has_state)
 
-        # Increment job_id counter
-        webserver.job_counter += 1
+        sync_wait = get_sync_wait(req)
+        if sync_wait is not None:
+            status = webserver.requests_solver.wait_for_job(job_id, sync_wait)
+            result = webserver.result_store.get(job_id)
+            if status in ("done", "error") and result is not None:
+                webserver.logger.info("Job id %s answered synchronously", job_id)
+                return result_response(status, result, 400 if status == "error" else 200, job_id,
+                                       get_debug_timings(req, job_id))
+
+            webserver.logger.info("Job id %s not finished in %ss", job_id, sync_wait)
 
         # Return associated job_id
         return jsonify({"job_id": job_id}), 200
@@ -33,34 +96,80 @@ def submit_request(endpoint, req, has_state = False):
     webserver.logger.error("Method not allowed - POST request expected. Got  %s", request.method)
     return jsonify({"error": "Method not allowed"}), 405
 
+def get_sync_wait(req):
+    """
+    Get the number of seconds to wait for the job to finish, given by the "wait"
+    query parameter or the "X-Wait" header, or None for an asynchronous response
+    """
+    sync_wait = req.args.get("wait", req.headers.get("X-Wait"))
+    if sync_wait is None:
+        return None
+
+    try:
+        return min(max(float(sync_wait), 0), MAX_SYNC_WAIT)
+    except ValueError:
+        webserver.logger.error("Invalid wait value: %s", sync_wait)
+        return None
+
+def get_debug_timings(req, job_id):
+    """
+    Get the timings of a job if the "debug" query parameter is set, otherwise None
+    """
+    if req.args.get("debug", "0").lower() in ("0", "false", ""):
+        return None
+    return webserver.jobs.get_timings(job_id)
+
+def result_response(status, result, code, job_id = None, timings = None):
+    """
+    Build the response for a finished job around its already encoded result,
+    without decoding and encoding the result again
+    """
+    body = b'{"status":"' + status.encode("utf-8") + b'","data":' + result + b'}'
+    if job_id is not None:
+        body = b'{"job_id":' + str(job_id).encode("utf-8") + b',' + body[1:]
+    if timings is not None:
+        body = body[:-1] + b',"timings":' + json.dumps(timings).encode("utf-8") + b'}'
+    return Response(body, status=code, mimetype="application/json")
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
     """
     Route to get the response for a job
+    With the "wait" query parameter or the "X-Wait" header, a running job is
+    waited for at most that many seconds before answering. With the "debug" query
+    parameter, the time the job reached each stage at is also returned
     """
     webserver.logger.info("Route /api/get_results/%s called", job_id)
     job_id = int(job_id)
 
-    # Check if job_id is valid
-    if 1 <= job_id < webserver.job_counter:
-        # Check the status for the job_id
-        status = webserver.job_status.get(job_id)
+    # Check if job_id is valid (evicted jobs are no longer valid)
+    status = webserver.jobs.get(job_id)
+    if status is not None:
+        sync_wait = get_sync_wait(request)
+        if status == "running" and sync_wait is not None:
+            status = webserver.requests_solver.wait_for_job(job_id, sync_wait)
         webserver.logger.info("Status for job_id_%s is %s", job_id, status)
 
         if status in ("done", "error"):
-            # Read the result from the output file
-            with open(f"results/job_id_{job_id}.json", "r", encoding="utf-8") as file:
-                data = json.load(file)
-                webserver.logger.info("Data for job_id_%s: %s", job_id, data)
-
-                # Return a relevant status code
-                if status == "error":
-                    code = 400
-                else:
-                    code = 200
-
-                return jsonify({"status": status, "data": data}), code
+            # Read the result from the result store
+            result = webserver.result_store.get(job_id)
+            if result is None:
+                webserver.logger.error("Result for job_id_%s expired", job_id)
+                return jsonify({"status": "error", "reason": "Result expired"}), 410
+
+            webserver.logger.info("Data for job_id_%s: %s bytes", job_id, len(result))
+
+            # Return a relevant status code
+            if status == "error":
+                code = 400
+            else:
+                code = 200
+
+            return result_response(status, result, code, timings=get_debug_timings(request, job_id))
         elif status == "running":
+            timings = get_debug_timings(request, job_id)
+            if timings is not None:
+                return jsonify({"status": status, "timings": timings}), 200
             return jsonify({"status": status}), 200
 
     webserver.logger.error("Invalid job_id: %s", job_id)
@@ -162,6 +271,16 @@ def state_mean_by_category_request():
         request,
         True)
 
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """
+    Route to get the answers for a list of {endpoint, question, state} items in a single job
+    """
+    webserver.logger.info("Route /api/batch called")
+    return submit_request(
+        requests_solver.batch,
+        request)
+
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def shutdown():
     """
@@ -171,18 +290,85 @@ def shutdown():
     webserver.tasks_runner.shutdown()
     return jsonify({"status": "done"}), 200
 
+@webserver.route('/api/reload', methods=['GET', 'POST'])
+def reload_dataset():
+    """
+    Route to reload the CSV in the background (POST) and to get the state of the reload (GET)
+    The new jobs use the new dataset once it is loaded, while the running ones
+    finish with the dataset they started with
+    """
+    webserver.logger.info("Route /api/reload called")
+    if request.method == 'POST':
+        if not webserver.reloader.reload():
+            webserver.logger.error("Reload already in progress")
+            return jsonify({"status": "error", "reason": "Reload already in progress"}), 409
+        webserver.logger.info("Reload started")
+
+    return jsonify({"status": "done", "data": webserver.reloader.status()}), 200
+
+@webserver.route('/api/ready', methods=['GET'])
+def get_ready():
+    """
+    Route to check whether the dataset is loaded and the jobs are computed right away
+    Answers 503, with the fraction of the CSV read so far, while the dataset is loaded
+    The jobs submitted meanwhile are queued and run once it is loaded
+    """
+    webserver.logger.info("Route /api/ready called")
+    status = webserver.reloader.status()
+    if not status["ready"]:
+        return jsonify({"status": "loading", "data": status}), 503
+    return jsonify({"status": "done", "data": status}), 200
+
+@webserver.route('/api/ingest', methods=['POST'])
+def ingest_rows():
+    """
+    Route to add new rows, given as {"rows": [{Question, LocationDesc,
+    StratificationCategory1, Stratification1, Data_Value}, ...]}, to the dataset
+    The rows are durably logged and the answers of the new jobs include them
+    """
+    webserver.logger.info("Route /api/ingest called")
+    data = request.get_json(silent=True)
+    try:
+        rows = parse_rows(data.get("rows") if isinstance(data, dict) else None)
+    except ValueError as exception:
+        webserver.logger.error("Invalid rows: %s", exception)
+        return jsonify({"status": "error", "reason": "Invalid rows"}), 400
+
+    try:
+        webserver.reloader.ingest(rows)
+    except TypeError as exception:
+        webserver.logger.error("Could not ingest rows: %s", exception)
+        return jsonify({"status": "error", "reason": str(exception)}), 400
+
+    webserver.logger.info("Ingested %s rows", len(rows))
+    return jsonify({"status": "done", "data": {"ingested": len(rows)}}), 200
+
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
     """
-    Route to get the status for all submitted jobs
+    Route to get the status for the submitted jobs
+    The "status" query parameter keeps only the jobs with that status. With the
+    "limit" query parameter, at most limit jobs with ids greater than the "cursor"
+    query parameter are returned, along with the cursor for the next page
     """
     webserver.logger.info("Route /api/jobs called")
-    statuses = [
-        {"job_id_" + str(job_id): status}
-        for job_id, status in webserver.job_status.items()
-    ]
-    webserver.logger.info("Jobs' statuses: %s", statuses)
-    return jsonify({"status": "done", "data": statuses}), 200
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = request.args.get("limit")
+        limit = int(limit) if limit is not None else None
+        if limit is not None and limit < 1:
+            raise ValueError(limit)
+    except ValueError:
+        webserver.logger.error("Invalid cursor or limit: %s", request.args)
+        return jsonify({"status": "error", "reason": "Invalid cursor or limit"}), 400
+
+    jobs, next_cursor = webserver.jobs.list(cursor, limit, request.args.get("status"))
+    statuses = [{"job_id_" + str(job_id): status} for job_id, status in jobs]
+    webserver.logger.info("Jobs' statuses: %s", webserver.log_payload(statuses))
+
+    if limit is None:
+        return jsonify({"status": "done", "data": statuses}), 200
+    return jsonify({"status": "done", "data": statuses, "next_cursor": next_cursor}), 200
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
@@ -190,14 +376,131 @@ def get_num_jobs():
     Route to get the number of running jobs
     """
     webserver.logger.info("Route /api/num_jobs called")
-    count = 0
-    for val in webserver.job_status.values():
-        if val == "running":
-            count += 1
+    count = webserver.jobs.count("running")
 
     webserver.logger.info("Number of running jobs: %s", count)
     return jsonify({"status": "done", "data": count}), 200
 
+@webserver.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Route to get the size and the hit/miss counters of the results cache
+    """
+    webserver.logger.info("Route /api/cache_stats called")
+    stats = webserver.requests_solver.cache.stats()
+    webserver.logger.info("Cache stats: %s", stats)
+    return jsonify({"status": "done", "data": stats}), 200
+
+@webserver.route('/api/result_store_stats', methods=['GET'])
+def get_result_store_stats():
+    """
+    Route to get the number of results and the memory used by the result store
+    """
+    webserver.logger.info("Route /api/result_store_stats called")
+    stats = webserver.result_store.stats()
+    webserver.logger.info("Result store stats: %s", stats)
+    return jsonify({"status": "done", "data": stats}), 200
+
+@webserver.route('/api/queue', methods=['GET'])
+def get_queue():
+    """
+    Route to get the depth of the job queue and the time the jobs wait in it
+    """
+    webserver.logger.info("Route /api/queue called")
+    stats = webserver.tasks_runner.queue_stats()
+    stats["rate_limited"] = webserver.rate_limiter.rejected
+    webserver.logger.info("Queue stats: %s", stats)
+    return jsonify({"status": "done", "data": stats}), 200
+
+@webserver.route('/api/memory', methods=['GET'])
+def get_memory():
+    """
+    Route to get the memory footprint of the dataset
+    """
+    webserver.logger.info("Route /api/memory called")
+    if webserver.data is None:
+        webserver.logger.error("Dataset not loaded yet")
+        return jsonify({"status": "error", "reason": "Dataset not loaded yet"}), 503
+
+    report = memory_report(webserver.data)
+    webserver.logger.info("Memory report: %s", report)
+    return jsonify({"status": "done", "data": report}), 200
+
+@webserver.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Route to get the request counters, the latency histograms and the state of the
+    thread pool, jobs, result store and cache in the Prometheus text format
+    """
+    webserver.logger.info("Route /api/metrics called")
+    tasks_runner = webserver.tasks_runner
+    queue = tasks_runner.queue_stats()
+    cache = webserver.requests_solver.cache.stats()
+    result_store = webserver.result_store.stats()
+
+    lines = webserver.http_requests.collect() + webserver.http_request_seconds.collect()
+    lines += webserver.job_requests.collect()
+    lines += tasks_runner.scheduled_jobs.collect() + tasks_runner.completed_jobs.collect()
+    lines += tasks_runner.queue_wait_seconds.collect() + tasks_runner.compute_seconds.collect()
+    lines += webserver.requests_solver.solved_requests.collect()
+    lines += format_metric("webserver_thread_pool_jobs", "gauge",
+                           "Jobs waiting for a worker (queued) and being computed (active)",
+                           [({"state": "queued"}, queue["queued"]),
+                            ({"state": "active"}, queue["active"])])
+    lines += format_metric("webserver_thread_pool_threads", "gauge",
+                           "Number of worker threads", [({}, tasks_runner.num_of_threads)])
+    lines += format_metric("webserver_jobs", "gauge", "Jobs in the registry, by status",
+                           [({"status": status}, webserver.jobs.count(status))
+                            for status in ("running", "done", "error")])
+    lines += format_metric("webserver_result_store_results", "gauge",
+                           "Results kept by the result store",
+                           [({"backend": result_store["backend"]}, result_store["results"])])
+    if "memory_used" in result_store:
+        lines += format_metric("webserver_result_store_memory_bytes", "gauge",
+                               "Memory used by the results kept in memory",
+                               [({}, result_store["memory_used"])])
+    lines += format_metric("webserver_cache_entries", "gauge",
+                           "Results kept by the results cache", [({}, cache["size"])])
+    lines += format_metric("webserver_cache_bytes", "gauge",
+                           "Bytes of results kept by the results cache", [({}, cache["bytes"])])
+    lines += format_metric("webserver_cache_requests_total", "counter",
+                           "Lookups in the results cache, by result",
+                           [({"result": "hit"}, cache["hits"]),
+                            ({"result": "miss"}, cache["misses"])])
+    lines += format_metric("webserver_cache_hit_ratio", "gauge",
+                           "Ratio of the lookups in the results cache that were hits",
+                           [({}, cache["hits"] / max(cache["hits"] + cache["misses"], 1))])
+
+    return Response("\n".join(lines) + "\n", status=200,
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@webserver.route('/api/profile', methods=['GET'])
+def get_profile():
+    """
+    Route to get the aggregated cProfile stats of the sampled solver calls, by endpoint
+    The "limit" and "sort" query parameters select the functions listed for each
+    endpoint, and the "reset" query parameter clears the stats after reporting them
+    """
+    webserver.logger.info("Route /api/profile called")
+    profiler = webserver.requests_solver.profiler
+    try:
+        limit = int(request.args.get("limit", 20))
+        if limit < 1:
+            raise ValueError(limit)
+        report = profiler.report(limit, request.args.get("sort", "cumulative"))
+    except (KeyError, ValueError):
+        webserver.logger.error("Invalid limit or sort: %s", request.args)
+        return jsonify({"status": "error", "reason": "Invalid limit or sort"}), 400
+
+    if request.args.get("reset", "0").lower() not in ("0", "false", ""):
+        profiler.reset()
+
+    webserver.logger.info("Profiled endpoints: %s", list(report))
+    return jsonify({
+        "status": "done",
+        "data": {"sample_rate": profiler.sample_rate, "endpoints": report},
+    }), 200
+
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
 @webserver.route('/index')
@@ -0,0 +1,83 @@
+"""
+Module that publishes the dataset in shared memory, so that the worker
+processes attach to the same columns instead of each holding a copy
+"""
+
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from app.dataset import COLUMNS
+
+def _attach_block(name):
+    """
+    Attach to an existing shared memory block without making the attaching process
+    responsible for it (the process that created the block unlinks it)
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        return SharedMemory(name=name)
+
+class SharedDataset:
+    """
+    Class that copies the code and numeric columns of the dataset to shared memory blocks
+    The process that creates it owns the blocks and must close it to free them
+    """
+    def __init__(self, data):
+        self.blocks = []
+        # Picklable description of the blocks, passed to the worker processes
+        self.descriptor = {}
+
+        for column in [column for column in COLUMNS if column in data]:
+            if pd.api.types.is_numeric_dtype(data[column]):
+                array = data[column].to_numpy()
+                categories = None
+            else:
+                # String columns are shared as their categorical codes
+                values = data[column].astype("category")
+                array = values.cat.codes.to_numpy()
+                categories = values.cat.categories.tolist()
+
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+
+            self.descriptor[column] = {
+                "name": block.name,
+                "dtype": array.dtype.str,
+                "length": len(array),
+                "categories": categories,
+            }
+
+    def close(self):
+        """
+        Release and remove the shared memory blocks
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+def attach_dataset(descriptor):
+    """
+    Build a dataframe backed directly by the shared memory blocks of a SharedDataset
+    Returns the dataframe and the attached blocks, which must be kept alive as long
+    as the dataframe is used
+    """
+    blocks = []
+    columns = {}
+    for column, info in descriptor.items():
+        block = _attach_block(info["name"])
+        blocks.append(block)
+
+        array = np.ndarray((info["length"],), dtype=np.dtype(info["dtype"]), buffer=block.buf)
+        array.flags.writeable = False
+        if info["categories"] is not None:
+            columns[column] = pd.Categorical.from_codes(array, categories=info["categories"])
+        else:
+            columns[column] = array
+
+    return pd.DataFrame(columns, copy=False), blocks
@@ -2,9 +2,54 @@
 Module that contains the thread pool class
 """
 
+import atexit
+import heapq
+import itertools
+import math
+import multiprocessing
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
+from threading import Event, Lock, Thread
+
+from app.metrics import Counter, Histogram
+from app.requests_solver import create_engine
+from app.shared_dataset import SharedDataset, attach_dataset
+
+# Relative cost of the endpoint functions, used to schedule the cheap jobs first
+# Endpoint functions that are not listed have a weight of 1
+ENDPOINT_WEIGHTS = {
+    "state_mean": 1,
+    "global_mean": 1,
+    "state_diff_from_mean": 1,
+    "state_mean_by_category": 2,
+    "states_mean": 2,
+    "best5": 2,
+    "worst5": 2,
+    "diff_from_mean": 2,
+    "mean_by_category": 8,
+    "batch": 8,
+}
+
+# Engine of a worker process, built once when the process starts, and the
+# shared memory blocks its dataset is backed by
+worker_engine = None
+worker_blocks = []
+
+def init_worker(descriptor, engine_name):
+    """
+    Initialize a worker process by attaching to the shared dataset and building its engine
+    """
+    global worker_engine, worker_blocks # pylint: disable=global-statement
+    data, worker_blocks = attach_dataset(descriptor)
+    worker_engine = create_engine(engine_name, data)
+
+def compute_in_worker(endpoint, args):
+    """
+    Compute the result of an endpoint function in a worker process
+    """
+    return endpoint(worker_engine, *args)
 
 class ThreadPool:
     """
@@ -20,35 +65,338 @@ class ThreadPool:
         # be used by the thread pool is equal to the number of CPUs of the system
         if num_of_threads is None:
             num_of_threads = os.cpu_count()
+        num_of_threads = int(num_of_threads)
 
+        self.num_of_threads = num_of_threads
         self.thread_pool = ThreadPoolExecutor(max_workers=num_of_threads)
 
+        # Check if environment variable TP_MAX_QUEUE_DEPTH is defined
+        # New jobs are rejected while this many jobs wait for a worker (0 means no limit)
+        self.max_queue_depth = int(os.getenv("TP_MAX_QUEUE_DEPTH", "1000"))
+        # Jobs waiting for a worker, jobs being computed and the time they spent
+        self.queued_jobs = 0
+        self.active_jobs = 0
+        self.rejected_jobs = 0
+        self.finished_jobs = 0
+        self.total_queue_wait = 0.0
+        self.total_compute_time = 0.0
+        self.stats_lock = Lock()
+
+        # Metrics exposed by /api/metrics
+        self.queue_wait_seconds = Histogram(
+            "webserver_job_queue_wait_seconds",
+            "Time the jobs waited for a worker, by endpoint function",
+            ("endpoint",),
+        )
+        self.compute_seconds = Histogram(
+            "webserver_job_compute_seconds",
+            "Time the jobs were computed for, by endpoint function",
+            ("endpoint",),
+        )
+        self.scheduled_jobs = Counter(
+            "webserver_jobs_scheduled_total",
+            "Jobs submitted to the thread pool, by endpoint function and by how they "
+            "were answered (cache, coalesced or queued)",
+            ("endpoint", "path"),
+        )
+        self.completed_jobs = Counter(
+            "webserver_jobs_completed_total",
+            "Jobs completed by the thread pool, by status",
+            ("status",),
+        )
+
+        # Check if environment variable TP_PRIORITY_SLACK is defined
+        # The jobs waiting for a worker are run in the order of their deadline: the time
+        # they were submitted at plus TP_PRIORITY_SLACK seconds for each unit of weight.
+        # Cheap jobs overtake the heavy ones, but a heavy job is never overtaken by
+        # jobs submitted more than (its weight - 1) * TP_PRIORITY_SLACK seconds after it
+        self.priority_slack = float(os.getenv("TP_PRIORITY_SLACK", "0.05"))
+        self.pending_jobs = []
+        self.pending_jobs_lock = Lock()
+        self.pending_jobs_counter = itertools.count()
+        # Cleared while the dataset is loaded in the background: the pending jobs
+        # wait for it to be set, and then run in the order of their deadline
+        self.data_ready = Event()
+        self.data_ready.set()
+
+        # Identical requests being computed, mapped to the ids of the jobs
+        # that are waiting for the same computation
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+        self.coalesced_jobs = 0
+
+        # Check if environment variable TP_BACKEND is defined
+        # With the process backend, the computations run in worker processes that
+        # attach to the dataset published in shared memory and build their engine
+        # once, while the threads only wait for the results
+        self.backend = os.getenv("TP_BACKEND", "thread")
+        if self.backend not in ("thread", "process"):
+            raise ValueError(f"Unknown thread pool backend: {self.backend}")
+
+        self.shared_dataset = None
+        self.process_pool = None
+        # Engine of the main process that the worker processes' engines were built like
+        self.process_pool_engine = None
+        self.process_pool_lock = Lock()
+        if self.backend == "process":
+            if webserver.data_chunk_rows > 0:
+                raise ValueError("The process backend requires the dataset in memory")
+            # A dataset loaded in the background gets its worker processes once it is loaded
+            if webserver.data is not None:
+                self.shared_dataset, self.process_pool = self.create_process_pool(webserver.data)
+                self.process_pool_engine = webserver.solver_engine
+
+    def create_process_pool(self, data):
+        """
+        Publish a dataset in shared memory and start the worker processes attached to it
+        """
+        shared_dataset = SharedDataset(data)
+        atexit.register(shared_dataset.close)
+        process_pool = ProcessPoolExecutor(
+            max_workers=self.num_of_threads,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+            initargs=(shared_dataset.descriptor, self.webserver.engine_name),
+        )
+        return shared_dataset, process_pool
+
+    def swap_dataset(self, data, engine):
+        """
+        With the process backend, start worker processes for a new dataset and engine
+        and retire the old ones once the computations already sent to them finish
+        The jobs that still use the old engine are then computed in their thread
+        """
+        if self.backend != "process":
+            return
+
+        shared_dataset, process_pool = self.create_process_pool(data)
+        with self.process_pool_lock:
+            old_shared_dataset, old_process_pool = self.shared_dataset, self.process_pool
+            self.shared_dataset, self.process_pool = shared_dataset, process_pool
+            self.process_pool_engine = engine
+
+        if old_process_pool is None:
+            return
+        Thread(
+            target=self.retire_process_pool,
+            args=(old_shared_dataset, old_process_pool),
+            daemon=True,
+        ).start()
+
+    def release_pending_jobs(self):
+        """
+        Run the jobs waiting for the dataset, once its engine is the one the jobs read
+        """
+        self.data_ready.set()
+
+    @staticmethod
+    def retire_process_pool(shared_dataset, process_pool):
+        """
+        Stop worker processes once their computations finish and free their shared dataset
+        """
+        process_pool.shutdown(wait=True)
+        shared_dataset.close()
+
     def shutdown(self):
         """
         Shutdown the thread pool
         """
+        # The jobs still waiting for the dataset can't wait for the shutdown
+        self.release_pending_jobs()
         self.thread_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.shared_dataset.close()
 
-    def handle_future_result(self, job_id: int, future):
+    def compute(self, endpoint, engine, args):
+        """
+        Compute the result of an endpoint function, either in the calling thread
+        or, with the process backend, in a worker process
+        A job always computes with the engine it started with: with the process backend,
+        the jobs that started before the dataset was swapped are computed in their thread
+        """
+        with self.process_pool_lock:
+            process_pool = self.process_pool
+            if engine is not self.process_pool_engine:
+                process_pool = None
+
+        if process_pool is not None:
+            try:
+                future = process_pool.submit(compute_in_worker, endpoint, args)
+            except RuntimeError:
+                # The dataset was swapped meanwhile and these worker processes retired
+                future = None
+            if future is not None:
+                return future.result()
+
+        return endpoint(engine, *args)
+
+    def is_saturated(self):
+        """
+        Check whether the queue is full, in which case new jobs should be rejected
+        """
+        saturated = 0 < self.max_queue_depth <= self.queued_jobs
+        if saturated:
+            with self.stats_lock:
+                self.rejected_jobs += 1
+        return saturated
+
+    def retry_after(self):
+        """
+        Estimate the number of seconds until the queued jobs are processed
+        """
+        with self.stats_lock:
+            average_compute_time = self.total_compute_time / max(self.finished_jobs, 1)
+            return max(1, math.ceil(self.queued_jobs * average_compute_time / self.num_of_threads))
+
+    def queue_stats(self):
+        """
+        Get the depth of the queue and the average time the jobs waited in it
+        """
+        with self.stats_lock:
+            return {
+                "queued": self.queued_jobs,
+                "active": self.active_jobs,
+                "max_queue_depth": self.max_queue_depth,
+                "rejected": self.rejected_jobs,
+                "average_queue_wait": self.total_queue_wait / max(self.finished_jobs, 1),
+                "average_compute_time": self.total_compute_time / max(self.finished_jobs, 1),
+            }
+
+    def run(self, submit_time, endpoint, job_id, request_args, has_state):
+        """
+        Run a job on a worker thread, keeping track of the queue depth and the time
+        the job waited in the queue and was computed for
+        """
+        start_time = time.monotonic()
+        with self.stats_lock:
+            self.queued_jobs -= 1
+            self.active_jobs += 1
+            self.total_queue_wait += start_time - submit_time
+
+        self.queue_wait_seconds.observe(start_time - submit_time, endpoint.__name__)
+        self.webserver.jobs.record(job_id, "dequeued")
+
+        try:
+            return self.webserver.requests_solver.solver(endpoint, job_id, request_args, has_state)
+        finally:
+            compute_time = time.monotonic() - start_time
+            self.compute_seconds.observe(compute_time, endpoint.__name__)
+            with self.stats_lock:
+                self.active_jobs -= 1
+                self.finished_jobs += 1
+                self.total_compute_time += compute_time
+
+    def run_next(self):
+        """
+        Run the pending job with the earliest deadline
+        Each job submitted to the thread pool executor runs one pending job,
+        which is not necessarily the job it was submitted for
+        While the dataset is loaded, the pending jobs wait for it
+        """
+        self.data_ready.wait()
+        with self.pending_jobs_lock:
+            _, _, future, job = heapq.heappop(self.pending_jobs)
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(self.run(*job))
+        except Exception as exception: # pylint: disable=broad-exception-caught
+            future.set_exception(exception)
+
+    def handle_future_result(self, job_id: int, key, future):
         """
         Method to be called whenever a job is completed by a thread
         Checks whether the future was completed successfully or encountered an exception
+        The jobs that were coalesced with this one complete with the same result
         """
+        followers = []
+        if key is not None:
+            with self.in_flight_lock:
+                followers = self.in_flight.pop(key, [])
+
+        requests_solver = self.webserver.requests_solver
         try:
-            future.result()
-            self.webserver.logger.info(f"Task with job id {job_id} completed successfully")
+            encoded_result, status = future.result()
+            self.webserver.logger.info("Task with job id %s completed successfully", job_id)
+            for follower_id in followers:
+                requests_solver.store_result(encoded_result, follower_id, status)
         except Exception as exception:
-            self.webserver.job_status[job_id] = "error"
-            self.webserver.requests_solver.write_result({"error_message": str(exception)}, job_id)
+            status = "error"
+            for failed_job_id in [job_id] + followers:
+                requests_solver.write_result(
+                    {"error_message": str(exception)}, failed_job_id, "error"
+                )
             self.webserver.logger.info(
                 "Task with job id %s failed with exception: %s", job_id, exception
             )
 
+        self.completed_jobs.inc(status, amount=1 + len(followers))
+
     def submit(self, endpoint, job_id, request_args, has_state):
         """
-        Submit a job to the thread pool executor
+        Submit a job to the thread pool executor and return its future
+        Jobs whose result is cached are completed right away, without using a worker,
+        and jobs identical to a job being computed wait for its result instead of being
+        computed again. In both cases, no future is returned
         """
-        future = self.thread_pool.submit(self.webserver.requests_solver.solver, endpoint, job_id, request_args, has_state)
-        self.webserver.logger.info(f"Task with job id {job_id} submitted")
+        requests_solver = self.webserver.requests_solver
+        key = requests_solver.request_key(endpoint, request_args, has_state)
+
+        if key is not None:
+            if requests_solver.solve_from_cache(key, job_id):
+                self.webserver.logger.info("Task with job id %s completed from cache", job_id)
+                self.scheduled_jobs.inc(endpoint.__name__, "cache")
+                return None
+
+            with self.in_flight_lock:
+                followers = self.in_flight.get(key)
+                if followers is not None:
+                    followers.append(job_id)
+                    self.coalesced_jobs += 1
+                else:
+                    self.in_flight[key] = []
+
+            if followers is not None:
+                self.webserver.logger.info(
+                    "Task with job id %s attached to an identical running task", job_id
+                )
+                self.scheduled_jobs.inc(endpoint.__name__, "coalesced")
+                return None
+
+        submit_time = time.monotonic()
+        deadline = submit_time + ENDPOINT_WEIGHTS.get(endpoint.__name__, 1) * self.priority_slack
+        future = Future()
+        entry = (
+            deadline,
+            next(self.pending_jobs_counter),
+            future,
+            (submit_time, endpoint, job_id, request_args, has_state),
+        )
+
+        with self.stats_lock:
+            self.queued_jobs += 1
+        try:
+            with self.pending_jobs_lock:
+                heapq.heappush(self.pending_jobs, entry)
+                try:
+                    self.thread_pool.submit(self.run_next)
+                except RuntimeError:
+                    self.pending_jobs.remove(entry)
+                    heapq.heapify(self.pending_jobs)
+                    raise
+        except RuntimeError:
+            # The thread pool was shut down, so no job will wait for this one
+            with self.stats_lock:
+                self.queued_jobs -= 1
+            if key is not None:
+                with self.in_flight_lock:
+                    self.in_flight.pop(key, None)
+            raise
+        self.webserver.logger.info("Task with job id %s submitted", job_id)
+        self.scheduled_jobs.inc(endpoint.__name__, "queued")
 
-        future.add_done_callback(partial(self.handle_future_result, job_id))
+        future.add_done_callback(partial(self.handle_future_result, job_id, key))
+        return future
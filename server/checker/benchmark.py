@@ -0,0 +1,311 @@
+"""
+Load-testing benchmark for the webserver
+
+Drives the server with the payloads in tests/<endpoint>/input, either in closed loop
+(a fixed number of clients, each sending its next request once the previous one
+is answered) or in open loop (requests sent at a fixed rate, whether or not the
+previous ones were answered). Each request is submitted and its result polled
+until the job is finished, so the end-to-end latency includes the poll overhead.
+
+Example:
+    python checker/benchmark.py --mode closed --concurrency 16 --duration 30
+    python checker/benchmark.py --mode open --rate 200 --mix state_mean=4,mean_by_category=1
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = [
+    "states_mean", "state_mean", "best5", "worst5", "global_mean", "diff_from_mean",
+    "state_diff_from_mean", "mean_by_category", "state_mean_by_category",
+]
+
+def load_payloads(tests_dir, endpoints):
+    """
+    Load the input payloads of the checker's tests for each endpoint
+    """
+    payloads = {}
+    for endpoint in endpoints:
+        input_dir = os.path.join(tests_dir, endpoint, "input")
+        payloads[endpoint] = []
+        for input_file in sorted(os.listdir(input_dir)):
+            with open(os.path.join(input_dir, input_file), "r", encoding="utf-8") as fin:
+                payloads[endpoint].append(json.load(fin))
+        if not payloads[endpoint]:
+            raise ValueError(f"No payloads in {input_dir}")
+    return payloads
+
+def parse_mix(value):
+    """
+    Parse the request mix, given as "endpoint=weight,endpoint=weight"
+    Every endpoint has the same weight by default
+    """
+    if not value:
+        return {endpoint: 1.0 for endpoint in ENDPOINTS}
+
+    mix = {}
+    for item in value.split(","):
+        endpoint, _, weight = item.partition("=")
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {endpoint}")
+        mix[endpoint] = float(weight) if weight else 1.0
+    return mix
+
+def percentile(values, fraction):
+    """
+    Get the nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def summarize(samples, elapsed):
+    """
+    Summarize the latencies (in milliseconds) and the throughput of a list of samples
+    """
+    ok = [sample for sample in samples if sample["ok"]]
+    latencies = sorted(sample["latency"] for sample in ok)
+    submit_latencies = sorted(sample["submit_latency"] for sample in ok)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput": round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        "latency_ms": {
+            "mean": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": milliseconds(percentile(latencies, 0.50)),
+            "p95": milliseconds(percentile(latencies, 0.95)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+        "submit_latency_ms": {
+            "p50": milliseconds(percentile(submit_latencies, 0.50)),
+            "p99": milliseconds(percentile(submit_latencies, 0.99)),
+        },
+        "polls_per_request": (
+            round(sum(sample["polls"] for sample in ok) / len(ok), 3) if ok else None
+        ),
+    }
+
+class Benchmark:
+    """
+    Class that sends the requests and records one sample for each of them
+    """
+    def __init__(self, args, payloads, mix):
+        self.args = args
+        self.payloads = payloads
+        self.endpoints = list(mix)
+        self.weights = [mix[endpoint] for endpoint in self.endpoints]
+        self.random = random.Random(args.seed)
+        self.random_lock = threading.Lock()
+        self.samples = []
+        self.samples_lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        """
+        Get the HTTP session of the calling thread
+        """
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def next_request(self):
+        """
+        Pick the endpoint and the payload of the next request according to the mix
+        """
+        with self.random_lock:
+            endpoint = self.random.choices(self.endpoints, self.weights)[0]
+            payload = self.random.choice(self.payloads[endpoint])
+        return endpoint, payload
+
+    def send(self, endpoint, payload, start_time):
+        """
+        Submit a request and poll its result until the job is finished
+        The latency is measured from start_time, the time the request was due at
+        """
+        sample = {"endpoint": endpoint, "ok": False, "polls": 0, "submit_latency": None}
+        session = self.session()
+        try:
+            wait = f"?wait={self.args.wait}" if self.args.wait else ""
+            res = session.post(f"{self.args.url}/api/{endpoint}{wait}", json=payload,
+                               timeout=self.args.timeout)
+            sample["submit_latency"] = time.perf_counter() - start_time
+            sample["code"] = res.status_code
+            body = res.json() if res.status_code == 200 else {}
+
+            status = body.get("status", "running" if "job_id" in body else "error")
+            deadline = start_time + self.args.timeout
+            while status == "running" and time.perf_counter() < deadline:
+                if sample["polls"] > 0:
+                    time.sleep(self.args.poll_interval)
+                sample["polls"] += 1
+                res = session.get(f"{self.args.url}/api/get_results/{body['job_id']}",
+                                  timeout=self.args.timeout)
+                sample["code"] = res.status_code
+                status = res.json().get("status", "error")
+
+            sample["ok"] = status == "done"
+        except (requests.RequestException, ValueError) as exception:
+            sample["error"] = str(exception)
+
+        sample["latency"] = time.perf_counter() - start_time
+        with self.samples_lock:
+            self.samples.append(sample)
+
+    def run_closed_loop(self):
+        """
+        Run concurrency clients, each sending its next request once the previous one
+        is answered, until the duration or the number of requests is reached
+        """
+        end_time = time.perf_counter() + self.args.duration
+        remaining = [self.args.requests]
+        remaining_lock = threading.Lock()
+
+        def client():
+            while time.perf_counter() < end_time:
+                if self.args.requests:
+                    with remaining_lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                endpoint, payload = self.next_request()
+                self.send(endpoint, payload, time.perf_counter())
+
+        threads = [threading.Thread(target=client) for _ in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self):
+        """
+        Send requests at a fixed rate (with exponential inter-arrival times) until the
+        duration or the number of requests is reached, whether or not the previous
+        ones were answered
+        The latency is measured from the time each request was due at, so a server
+        that falls behind is not hidden by the client falling behind too
+        """
+        sent = 0
+        next_time = time.perf_counter()
+        end_time = next_time + self.args.duration
+        with ThreadPoolExecutor(max_workers=self.args.max_in_flight) as executor:
+            while next_time < end_time and (not self.args.requests or sent < self.args.requests):
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                endpoint, payload = self.next_request()
+                executor.submit(self.send, endpoint, payload, next_time)
+                sent += 1
+                with self.random_lock:
+                    next_time += self.random.expovariate(self.args.rate)
+
+    def run(self):
+        """
+        Run the benchmark and return the report
+        """
+        start_time = time.perf_counter()
+        if self.args.mode == "closed":
+            self.run_closed_loop()
+        else:
+            self.run_open_loop()
+        elapsed = time.perf_counter() - start_time
+
+        by_endpoint = {}
+        for sample in self.samples:
+            by_endpoint.setdefault(sample["endpoint"], []).append(sample)
+
+        return {
+            "config": {
+                "url": self.args.url,
+                "mode": self.args.mode,
+                "concurrency": self.args.concurrency if self.args.mode == "closed" else None,
+                "rate": self.args.rate if self.args.mode == "open" else None,
+                "duration": self.args.duration,
+                "requests": self.args.requests,
+                "mix": dict(zip(self.endpoints, self.weights)),
+                "poll_interval": self.args.poll_interval,
+                "wait": self.args.wait,
+                "seed": self.args.seed,
+            },
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "elapsed": round(elapsed, 3),
+            "summary": summarize(self.samples, elapsed),
+            "endpoints": {
+                endpoint: summarize(samples, elapsed)
+                for endpoint, samples in sorted(by_endpoint.items())
+            },
+        }
+
+def parse_arguments(argv):
+    """
+    Parse the command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Load-testing benchmark for the webserver")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--tests-dir", default="tests",
+                        help="directory with the <endpoint>/input payloads")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of clients in closed loop")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="requests per second in open loop")
+    parser.add_argument("--max-in-flight", type=int, default=256,
+                        help="maximum number of requests in flight in open loop")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="stop after this many requests (0 means no limit)")
+    parser.add_argument("--mix", default="",
+                        help="endpoint weights, e.g. state_mean=4,mean_by_category=1")
+    parser.add_argument("--poll-interval", type=float, default=0.005,
+                        help="seconds between the polls of a result")
+    parser.add_argument("--wait", type=float, default=0,
+                        help="seconds the server may wait for the job before answering")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds after which a request is counted as an error")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON report to")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    """
+    Run the benchmark and print the report
+    """
+    args = parse_arguments(argv)
+    mix = parse_mix(args.mix)
+    benchmark = Benchmark(args, load_payloads(args.tests_dir, list(mix)), mix)
+    report = benchmark.run()
+
+    summary = report["summary"]
+    print(f"{args.mode} loop: {summary['requests']} requests, {summary['errors']} errors, "
+          f"{summary['throughput']} req/s")
+    print(f"{'endpoint':<24}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'polls':>8}")
+    for endpoint, stats in list(report["endpoints"].items()) + [("all", summary)]:
+        latency = stats["latency_ms"]
+        print(f"{endpoint:<24}{stats['requests']:>10}{stats['throughput']:>10}"
+              f"{latency['p50']!s:>10}{latency['p95']!s:>10}{latency['p99']!s:>10}"
+              f"{stats['polls_per_request']!s:>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump(report, fout, indent=2)
+        print(f"Report written to {args.output}")
+
+    return 0 if summary["errors"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Microbenchmark for the helpers in app/requests_solver.py
+
+Times each helper directly, without going through HTTP, for each solver engine,
+on synthetic datasets 1x, 10x, 100x and 1000x the size of the subset CSV. The
+synthetic rows are sampled (with replacement) from the CSV, so the distributions
+of Question, LocationDesc and the stratifications are kept. For each helper, it
+reports the calls per second, the peak memory allocated by a call and the number
+of memory blocks it allocated, and it fails
+when a helper regresses past a stored baseline.
+
+Must be run from the server directory. The baseline depends on the machine, so it
+is recorded first on the machine that runs the comparison, e.g.:
+    python checker/solver_benchmark.py --scales 1,10 --save-baseline solver_baseline.json
+    python checker/solver_benchmark.py --scales 1,10 --baseline solver_baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+# Make the app package importable when the script is run as checker/solver_benchmark.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from app import constants, requests_solver
+from app.dataset import load_dataset
+
+FUNCTIONS = [
+    (requests_solver.states_mean, False),
+    (requests_solver.state_mean, True),
+    (requests_solver.best5, False),
+    (requests_solver.worst5, False),
+    (requests_solver.global_mean, False),
+    (requests_solver.diff_from_mean, False),
+    (requests_solver.state_diff_from_mean, True),
+    (requests_solver.mean_by_category, False),
+    (requests_solver.state_mean_by_category, True),
+]
+
+def scale_dataset(data, scale, seed):
+    """
+    Generate a dataset scale times the size of data by sampling its rows with replacement
+    """
+    if scale == 1:
+        return data
+    return data.sample(n=len(data) * scale, replace=True, random_state=seed).reset_index(drop=True)
+
+def function_arguments(data, has_state):
+    """
+    Get the arguments the helper is called with, rotated over the questions and states
+    """
+    states = [state for state in data["LocationDesc"].cat.categories if state in constants.STATES]
+    if not has_state:
+        return [(question,) for question in constants.QUESTIONS]
+    return [
+        (question, states[index % len(states)])
+        for index, question in enumerate(constants.QUESTIONS * 3)
+    ]
+
+def measure(function, engine, arguments, min_time):
+    """
+    Measure the calls per second of a helper, called at least once and for at least
+    min_time seconds, along with the peak memory allocated by one call and the number
+    of blocks it allocated that are still allocated when it returns (its result included)
+    """
+    calls = 0
+    start_time = time.perf_counter()
+    elapsed = 0.0
+    while calls == 0 or elapsed < min_time:
+        function(engine, *arguments[calls % len(arguments)])
+        calls += 1
+        elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    try:
+        function(engine, *arguments[0])
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The snapshots are taken around a separate call so as not to count in the peak
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = function(engine, *arguments[0])
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    alloc_count = sum(
+        max(stat.count_diff, 0) for stat in after.compare_to(before, "filename")
+    )
+    return {
+        "ops_per_sec": round(calls / elapsed, 3),
+        "calls": calls,
+        "alloc_peak_bytes": peak_bytes,
+        "alloc_count": alloc_count,
+    }
+
+def run(args):
+    """
+    Run the benchmark for each scale and engine and return the results,
+    keyed by engine/scale/helper
+    """
+    base_data = load_dataset(args.csv, snapshot=False)
+    results = {}
+    for scale in args.scales:
+        data = scale_dataset(base_data, scale, args.seed)
+        print(f"Scale {scale}x: {len(data)} rows")
+
+        for engine_name in args.engines:
+            start_time = time.perf_counter()
+            engine = requests_solver.create_engine(engine_name, data)
+            build_time = time.perf_counter() - start_time
+            results[f"{engine_name}/{scale}x/build"] = {"seconds": round(build_time, 6)}
+
+            for function, has_state in FUNCTIONS:
+                if args.functions and function.__name__ not in args.functions:
+                    continue
+                result = measure(
+                    function, engine, function_arguments(data, has_state), args.min_time
+                )
+                results[f"{engine_name}/{scale}x/{function.__name__}"] = result
+                print(f"  {engine_name:<8}{function.__name__:<24}"
+                      f"{result['ops_per_sec']:>14.1f} ops/s"
+                      f"{result['alloc_peak_bytes']:>14} B allocated"
+                      f"{result['alloc_count']:>10} blocks")
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results with the baseline
+    Returns the regressions: helpers at least tolerance slower, or allocating
+    at least tolerance more memory or blocks, than in the baseline
+    """
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None or "ops_per_sec" not in result:
+            continue
+
+        if result["ops_per_sec"] < reference["ops_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{key}: {result['ops_per_sec']} ops/s, baseline {reference['ops_per_sec']}"
+            )
+        if result["alloc_peak_bytes"] > reference["alloc_peak_bytes"] * (1 + tolerance):
+            regressions.append(
+                f"{key}: {result['alloc_peak_bytes']} B allocated, "
+                f"baseline {reference['alloc_peak_bytes']}"
+            )
+        # Baselines recorded before the allocation counts were measured have none
+        if result["alloc_count"] > reference.get("alloc_count", math.inf) * (1 + tolerance):
+            regressions.append(
+                f"{key}: {result['alloc_count']} blocks allocated, "
+                f"baseline {reference['alloc_count']}"
+            )
+    return regressions
+
+def parse_arguments(argv):
+    """
+    Parse the command line arguments
+    """
+    def integers(value):
+        return [int(item) for item in value.split(",") if item]
+
+    def names(value):
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    parser = argparse.ArgumentParser(description="Microbenchmark for the solver helpers")
+    parser.add_argument("--csv", default="./nutrition_activity_obesity_usa_subset.csv")
+    parser.add_argument("--scales", type=integers, default=[1, 10, 100, 1000],
+                        help="sizes of the synthetic datasets, as multiples of the CSV")
+    parser.add_argument("--engines", type=names, default=list(requests_solver.ENGINES),
+                        help="solver engines to benchmark")
+    parser.add_argument("--functions", type=names, default=[],
+                        help="helpers to benchmark (all by default)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum number of seconds each helper is timed for")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="baseline to compare the results with")
+    parser.add_argument("--save-baseline", help="file to store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction by which a helper may regress before failing")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    """
+    Run the benchmark and check it against the baseline
+    """
+    args = parse_arguments(argv)
+    for engine_name in args.engines:
+        if engine_name not in requests_solver.ENGINES:
+            raise ValueError(f"Unknown solver engine: {engine_name}")
+    # The timings depend on the machine, so the baseline is recorded on the machine
+    # that runs the benchmark instead of being part of the repository
+    if args.baseline and not os.path.isfile(args.baseline):
+        print(f"No baseline found at {args.baseline}: record one on this machine first, "
+              f"with --save-baseline {args.baseline}")
+        return 2
+
+    results = run(args)
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+        print(f"Results written to {path}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fin:
+            regressions = compare(results, json.load(fin), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regression against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 """
 Constants for the unittests
 """
+import numpy as np
 import pandas as pd
 
 mock_df1 = pd.DataFrame(
@@ -53,4 +54,18 @@ mock_df3 = pd.DataFrame(
     columns=["LocationDesc", "Question", "StratificationCategory1", "Stratification1", "Data_Value"],
 )
 
-mock_question = "Percent of adults aged 18 years and older who have an overweight classification"
\ No newline at end of file
+mock_question = "Percent of adults aged 18 years and older who have an overweight classification"
+
+def make_float_dataset(rows, seed = 0):
+    """
+    Generate a dataset of rows random rows with one-decimal values, like the CSV's,
+    whose sums are not exact in floating point
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "LocationDesc": rng.choice([f"State{i}" for i in range(8)], rows),
+        "Question": rng.choice(["Question1", "Question2", "Question3"], rows),
+        "StratificationCategory1": rng.choice(["Category1", "Category2"], rows),
+        "Stratification1": rng.choice(["SubCategory1", "SubCategory2", "SubCategory3"], rows),
+        "Data_Value": rng.integers(0, 1000, rows) / 10,
+    })
@@ -3,18 +3,82 @@ Unit tests for the webserver
 """
 
 import unittest
+from unittest import mock
 import json
+import logging
+import os
+import tempfile
 from time import sleep
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from threading import Event
 import requests
+import pandas as pd
+from flask import Flask
 
 from app import requests_solver
+from app import constants as app_constants
+from app.aggregate_index import AggregateIndex
+from app.numpy_engine import NumpyEngine
+from app.result_cache import ResultCache
+from app.result_store import DiskResultStore, MemoryResultStore
+from app.dataset import (
+    COLUMNS, fingerprint, load_dataset, memory_report, read_snapshot, stream_index
+)
+from app.shared_dataset import SharedDataset, attach_dataset
+from app.job_registry import JobRegistry
+from app.dataset_reloader import DatasetReloader
+from app.ingestion import IngestionLog, parse_rows
+from app.task_runner import ThreadPool
+from app.rate_limiter import RateLimiter
+from app.metrics import Counter, Histogram
+from app.profiler import SamplingProfiler
+from app.async_logging import PayloadSampler, RouteLevelFilter, parse_route_levels
 from unittests import constants
 
+def worker_states_mean(data, _):
+    """
+    Endpoint function run by the worker processes, which also returns their pid
+    """
+    return {"pid": os.getpid(), "data": requests_solver.states_mean(data, "Question1")}
+
 class TestWebserver(unittest.TestCase):
     """
     Test class
     """
 
+    def make_webserver(self, backend = "thread", **attributes):
+        """
+        Build a stub of the webserver with a job registry, a result store, a solver
+        and a thread pool with the given backend, shut down at the end of the test
+        """
+        webserver = SimpleNamespace(**{
+            "logger": logging.getLogger(__name__), "data": None, "solver_engine": None,
+            "data_chunk_rows": 0, "engine_name": "index",
+        } | attributes)
+        webserver.jobs = JobRegistry(0)
+        webserver.result_store = MemoryResultStore(memory_budget=1024, ttl=0)
+        webserver.requests_solver = requests_solver.RequestsSolver(webserver)
+        with mock.patch.dict(os.environ, {"TP_BACKEND": backend}):
+            webserver.tasks_runner = ThreadPool(webserver)
+        self.addCleanup(webserver.tasks_runner.shutdown)
+        return webserver
+
+    def make_dataset_webserver(self, directory, loaded = True):
+        """
+        Build a stub of the webserver for the dataset in data.csv in directory,
+        with an ingestion log next to it, and the dataset loaded if loaded is set
+        """
+        path = os.path.join(directory, "data.csv")
+        constants.mock_df3.to_csv(path, index=False)
+        data = load_dataset(path, snapshot=False) if loaded else None
+        return self.make_webserver(
+            data_path=path, data_snapshot=False, data=data,
+            solver_engine=requests_solver.create_engine("index", data) if loaded else None,
+            ingestion_log=IngestionLog(os.path.join(directory, "ingest.jsonl")),
+        )
+
     def test_states_mean(self):
         """
         Test the states_mean helper function
@@ -118,6 +182,676 @@ class TestWebserver(unittest.TestCase):
             },
         )
 
+    def test_solver_engines(self):
+        """
+        Test that the helper functions give the same results when answered
+        from the aggregate index or the numpy engine instead of the dataframe
+        """
+        for engine in (AggregateIndex, NumpyEngine):
+            engine1 = engine(constants.mock_df1)
+            engine2 = engine(constants.mock_df2)
+            engine3 = engine(constants.mock_df3)
+
+            for helper, data, source in [
+                (requests_solver.states_mean, constants.mock_df1, engine1),
+                (requests_solver.best5, constants.mock_df2, engine2),
+                (requests_solver.worst5, constants.mock_df2, engine2),
+                (requests_solver.global_mean, constants.mock_df1, engine1),
+                (requests_solver.diff_from_mean, constants.mock_df1, engine1),
+                (requests_solver.mean_by_category, constants.mock_df3, engine3),
+            ]:
+                with self.subTest(engine=engine.__name__, helper=helper.__name__):
+                    self.assertEqual(helper(source, "Question1"), helper(data, "Question1"))
+
+            for helper, data, source in [
+                (requests_solver.state_mean, constants.mock_df1, engine1),
+                (requests_solver.state_diff_from_mean, constants.mock_df1, engine1),
+                (requests_solver.state_mean_by_category, constants.mock_df3, engine3),
+            ]:
+                with self.subTest(engine=engine.__name__, helper=helper.__name__):
+                    self.assertEqual(
+                        helper(source, "Question1", "State1"),
+                        helper(data, "Question1", "State1"),
+                    )
+
+    def test_numpy_engine_exact(self):
+        """
+        Test that the numpy engine gives byte-identical results to the dataframe
+        on non-integer values, which are not summed exactly
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            constants.make_float_dataset(2000).to_csv(path, index=False)
+            data = load_dataset(path, snapshot=False)
+        engine = NumpyEngine(data)
+
+        for question in data["Question"].cat.categories:
+            for helper in (requests_solver.states_mean, requests_solver.global_mean,
+                           requests_solver.diff_from_mean, requests_solver.mean_by_category):
+                with self.subTest(helper=helper.__name__, question=question):
+                    self.assertEqual(json.dumps(helper(engine, question)),
+                                     json.dumps(helper(data, question)))
+
+            for state in data["LocationDesc"].cat.categories:
+                for helper in (requests_solver.state_mean, requests_solver.state_mean_by_category):
+                    with self.subTest(helper=helper.__name__, question=question, state=state):
+                        self.assertEqual(json.dumps(helper(engine, question, state)),
+                                         json.dumps(helper(data, question, state)))
+
+    def test_result_cache(self):
+        """
+        Test the LRU eviction and the invalidation of the results cache
+        """
+        engine1, engine2 = object(), object()
+        cache = ResultCache(2)
+
+        self.assertIsNone(cache.get("key1", engine1))
+        cache.put("key1", {"result": 1}, engine1)
+        cache.put("key2", {"result": 2}, engine1)
+        self.assertEqual(cache.get("key1", engine1), {"result": 1})
+
+        # key2 is the least recently used entry, so it gets evicted
+        cache.put("key3", {"result": 3}, engine1)
+        self.assertIsNone(cache.get("key2", engine1))
+        self.assertEqual(cache.get("key3", engine1), {"result": 3})
+
+        # Changing the engine drops the cached results
+        self.assertIsNone(cache.get("key1", engine2))
+        cache.put("key1", {"result": 4}, engine1)
+        self.assertIsNone(cache.get("key1", engine2))
+
+        self.assertEqual(cache.stats(), {
+            "size": 0, "max_size": 2, "bytes": 0, "max_bytes": 0, "hits": 2, "misses": 4,
+        })
+
+        # The cache also keeps at most max_bytes bytes of results, and none over max_entry_bytes
+        cache = ResultCache(10, max_bytes=10, max_entry_bytes=6)
+        self.assertIsNone(cache.get("key1", engine1))
+        cache.put("key1", b"1234", engine1)
+        cache.put("key2", b"123456", engine1)
+        cache.put("batch", b"1234567", engine1)
+        self.assertIsNone(cache.get("batch", engine1))
+        self.assertEqual(cache.get("key1", engine1), b"1234")
+        cache.put("key3", b"12", engine1)
+        self.assertIsNone(cache.get("key2", engine1))
+        self.assertEqual(cache.stats()["bytes"], 6)
+
+    def test_cached_result(self):
+        """
+        Test that a cached result is stored for a new job without being serialized again
+        """
+        webserver = self.make_webserver(solver_engine=constants.mock_df1)
+
+        def states_mean(data, _):
+            return requests_solver.states_mean(data, "Question1")
+
+        job_ids = [webserver.jobs.new_job() for _ in range(2)]
+        request_args = {"question": constants.mock_question}
+        webserver.tasks_runner.submit(states_mean, job_ids[0], request_args, False)
+        self.assertEqual(webserver.requests_solver.wait_for_job(job_ids[0], 5), "done")
+
+        with mock.patch("app.requests_solver.json.dumps") as dumps:
+            self.assertIsNone(
+                webserver.tasks_runner.submit(states_mean, job_ids[1], request_args, False)
+            )
+        dumps.assert_not_called()
+        self.assertEqual(webserver.jobs.get(job_ids[1]), "done")
+        self.assertEqual(webserver.result_store.get(job_ids[1]),
+                         webserver.result_store.get(job_ids[0]))
+
+    def test_memory_result_store(self):
+        """
+        Test the spilling to disk and the TTL expiry of the memory result store
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            store = MemoryResultStore(
+                memory_budget=10, ttl=0.1, spill_size=8, spill_store=DiskResultStore(directory)
+            )
+
+            # Results over spill_size go straight to disk
+            store.put(1, b'{"a": 1.0}')
+            # The oldest result is spilled once the memory budget is exceeded
+            store.put(2, b'{"b": 1}')
+            store.put(3, b'{"c": 1}')
+            self.assertEqual(store.stats()["spilled"], 2)
+            self.assertEqual(store.stats()["memory_used"], 8)
+
+            self.assertEqual(store.get(1), b'{"a": 1.0}')
+            self.assertEqual(store.get(2), b'{"b": 1}')
+            self.assertEqual(store.get(3), b'{"c": 1}')
+            self.assertIsNone(store.get(4))
+
+            # Collected results expire after the TTL
+            sleep(0.2)
+            self.assertIsNone(store.get(1))
+            self.assertIsNone(store.get(3))
+            self.assertEqual(store.stats()["results"], 0)
+
+        # Without a spill store, the collected results are evicted first, then the oldest
+        store = MemoryResultStore(memory_budget=16, ttl=0)
+        store.put(1, b'{"a":1}')
+        store.put(2, b'{"b":1}')
+        self.assertEqual(store.get(2), b'{"b":1}')
+        store.put(3, b'{"c":1}')
+        self.assertIsNone(store.get(2))
+        self.assertEqual(store.get(1), b'{"a":1}')
+        for job_id in range(4, 1000):
+            store.put(job_id, b'{"d":1}')
+        self.assertLessEqual(store.stats()["memory_used"], 16)
+        self.assertEqual(store.stats()["evicted"], 997)
+        self.assertEqual(store.get(999), b'{"d":1}')
+
+    def test_load_dataset(self):
+        """
+        Test that only the used columns are loaded, as categoricals,
+        and that the rows without a value are dropped
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            data = constants.mock_df3.assign(YearStart=2020)
+            data.loc[len(data)] = ["State1", "Question1", "Category1", "SubCategory1", None, 2020]
+            data.to_csv(path, index=False)
+
+            dataset = load_dataset(path)
+            self.assertEqual(sorted(dataset.columns), sorted(COLUMNS))
+            self.assertEqual(len(dataset), len(constants.mock_df3))
+            self.assertEqual(dataset["Question"].dtype, "category")
+            self.assertEqual(
+                requests_solver.mean_by_category(dataset, "Question1"),
+                requests_solver.mean_by_category(constants.mock_df3, "Question1"),
+            )
+            report = memory_report(dataset)
+            self.assertEqual(report["rows"], len(constants.mock_df3))
+            self.assertLessEqual(report["process_rss_bytes"], report["process_max_rss_bytes"])
+
+    def test_stream_index(self):
+        """
+        Test that the index streamed from the CSV in chunks answers like the in-memory dataset
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            data = constants.mock_df3.assign(YearStart=2020)
+            data.loc[len(data)] = ["State1", "Question1", "Category1", "SubCategory1", None, 2020]
+            data.to_csv(path, index=False)
+
+            index = stream_index(path, chunk_rows=3)
+            for function, args in [
+                (requests_solver.states_mean, ("Question1",)),
+                (requests_solver.state_mean, ("Question1", "State2")),
+                (requests_solver.best5, ("Question1",)),
+                (requests_solver.global_mean, ("Question2",)),
+                (requests_solver.diff_from_mean, ("Question1",)),
+                (requests_solver.mean_by_category, ("Question1",)),
+                (requests_solver.state_mean_by_category, ("Question1", "State1")),
+            ]:
+                self.assertEqual(function(index, *args), function(constants.mock_df3, *args))
+
+            # Non-integer values give the same sums whatever the chunks they are read in
+            constants.make_float_dataset(3000).to_csv(path, index=False)
+            data = load_dataset(path, snapshot=False)
+            index = AggregateIndex(data)
+            for chunk_rows in (97, 1000, 2999):
+                chunks = stream_index(path, chunk_rows)
+                for question in data["Question"].cat.categories:
+                    for function in (requests_solver.states_mean, requests_solver.global_mean,
+                                     requests_solver.mean_by_category):
+                        with self.subTest(chunk_rows=chunk_rows, function=function.__name__):
+                            self.assertEqual(json.dumps(function(chunks, question)),
+                                             json.dumps(function(index, question)))
+
+    def test_dataset_snapshot(self):
+        """
+        Test that the snapshot is used while the CSV is unchanged and rebuilt when it changes
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            constants.mock_df3.to_csv(path, index=False)
+
+            dataset = load_dataset(path)
+            self.assertTrue(os.path.isfile(f"{path}.snapshot/meta.json"))
+            self.assertEqual(read_snapshot(f"{path}.snapshot", fingerprint(path)).to_dict(),
+                             dataset.to_dict())
+            self.assertEqual(load_dataset(path).to_dict(), dataset.to_dict())
+
+            constants.mock_df1.assign(
+                StratificationCategory1="Category1", Stratification1="SubCategory1"
+            ).to_csv(path, index=False)
+            self.assertIsNone(read_snapshot(f"{path}.snapshot", fingerprint(path)))
+            self.assertEqual(len(load_dataset(path)), len(constants.mock_df1))
+            self.assertEqual(len(read_snapshot(f"{path}.snapshot", fingerprint(path))),
+                             len(constants.mock_df1))
+
+    def test_dataset_reload(self):
+        """
+        Test that a reloaded dataset is swapped in for the new jobs while the old engine
+        keeps answering, and that a failed reload keeps the current dataset
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            webserver = self.make_dataset_webserver(directory)
+            path = webserver.data_path
+            reloader = DatasetReloader(webserver)
+            old_engine = webserver.solver_engine
+            old_mean = requests_solver.global_mean(old_engine, "Question1")
+
+            constants.mock_df3.assign(Data_Value=constants.mock_df3["Data_Value"] * 2).to_csv(
+                path, index=False
+            )
+            self.assertTrue(reloader.reload())
+            while reloader.status()["reloading"]:
+                sleep(0.01)
+
+            self.assertEqual(reloader.status()["generation"], 2)
+            self.assertIsNot(webserver.solver_engine, old_engine)
+            self.assertAlmostEqual(
+                requests_solver.global_mean(webserver.solver_engine, "Question1")["global_mean"],
+                2 * old_mean["global_mean"],
+            )
+            self.assertEqual(requests_solver.global_mean(old_engine, "Question1"), old_mean)
+
+            os.remove(path)
+            self.assertTrue(reloader.reload())
+            while reloader.status()["reloading"]:
+                sleep(0.01)
+            self.assertEqual(reloader.status()["generation"], 2)
+            self.assertIsNotNone(reloader.status()["last_error"])
+
+    def test_ingestion(self):
+        """
+        Test that ingested rows are reflected by a new engine, logged and replayed
+        on top of the CSV, and that invalid rows are rejected
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            webserver = self.make_dataset_webserver(directory)
+            path = webserver.data_path
+            reloader = DatasetReloader(webserver)
+            old_engine = webserver.solver_engine
+
+            rows = parse_rows([
+                {"LocationDesc": "State3", "Question": "Question1",
+                 "StratificationCategory1": "Category1", "Stratification1": "SubCategory1",
+                 "Data_Value": 7},
+                {"LocationDesc": "State1", "Question": "Question2",
+                 "StratificationCategory1": "Category1", "Stratification1": "SubCategory1",
+                 "Data_Value": None},
+            ])
+            self.assertEqual(len(rows), 1)
+            reloader.ingest(rows)
+
+            expected = pd.concat([constants.mock_df3, pd.DataFrame(rows)], ignore_index=True)
+            for function, args in [
+                (requests_solver.states_mean, ("Question1",)),
+                (requests_solver.global_mean, ("Question1",)),
+                (requests_solver.mean_by_category, ("Question1",)),
+                (requests_solver.state_mean_by_category, ("Question1", "State3")),
+            ]:
+                self.assertEqual(
+                    function(webserver.solver_engine, *args), function(expected, *args)
+                )
+            # The old engine is left unchanged for the running jobs
+            self.assertEqual(
+                requests_solver.states_mean(old_engine, "Question1"),
+                requests_solver.states_mean(constants.mock_df3, "Question1"),
+            )
+
+            replayed, log_lines = IngestionLog(webserver.ingestion_log.path).replay(
+                load_dataset(path, snapshot=False)
+            )
+            self.assertEqual(log_lines, 1)
+            self.assertEqual(
+                requests_solver.mean_by_category(replayed, "Question1"),
+                requests_solver.mean_by_category(expected, "Question1"),
+            )
+
+            with mock.patch.object(webserver.tasks_runner, "backend", "process"):
+                with self.assertRaises(TypeError):
+                    reloader.ingest(rows)
+
+            for invalid_rows in [[], "rows", [{"Question": "Question1"}],
+                                 [dict(rows[0], Data_Value="7")]]:
+                with self.assertRaises(ValueError):
+                    parse_rows(invalid_rows)
+
+    def test_lazy_load(self):
+        """
+        Test that the jobs submitted while the dataset is loaded in the background wait
+        for it, with the rows ingested meanwhile, and that the progress is reported
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            webserver = self.make_dataset_webserver(directory, loaded=False)
+            path = webserver.data_path
+            webserver.tasks_runner.data_ready.clear()
+            reloader = DatasetReloader(webserver)
+            self.assertFalse(reloader.status()["ready"])
+
+            def global_mean(engine, _):
+                return requests_solver.global_mean(engine, "Question1")
+
+            job_id = webserver.jobs.new_job()
+            webserver.tasks_runner.submit(
+                global_mean, job_id, {"question": constants.mock_question}, False
+            )
+            rows = parse_rows([{"LocationDesc": "State3", "Question": "Question1",
+                                "StratificationCategory1": "Category1",
+                                "Stratification1": "SubCategory1", "Data_Value": 7}])
+            reloader.ingest(rows)
+            self.assertEqual(webserver.requests_solver.wait_for_job(job_id, 0.1), "running")
+            self.assertEqual(webserver.tasks_runner.queue_stats()["queued"], 1)
+
+            self.assertTrue(reloader.reload())
+            self.assertEqual(webserver.requests_solver.wait_for_job(job_id, 5), "done")
+            expected = pd.concat([constants.mock_df3, pd.DataFrame(rows)], ignore_index=True)
+            self.assertEqual(
+                json.loads(webserver.result_store.get(job_id)),
+                requests_solver.global_mean(expected, "Question1"),
+            )
+            while reloader.status()["reloading"]:
+                sleep(0.01)
+            self.assertTrue(reloader.status()["ready"])
+            self.assertEqual(reloader.status()["generation"], 1)
+
+            progress = []
+            load_dataset(path, snapshot=False,
+                         progress=lambda read, size: progress.append((read, size)))
+            self.assertEqual(progress[-1], (os.path.getsize(path), os.path.getsize(path)))
+
+    def test_lazy_load_workers(self):
+        """
+        Test that the jobs queued on several workers while the dataset is loaded
+        only start once its engine is swapped in
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            webserver = self.make_dataset_webserver(directory, loaded=False)
+            tasks_runner = webserver.tasks_runner
+            tasks_runner.thread_pool.shutdown()
+            tasks_runner.thread_pool = ThreadPoolExecutor(max_workers=8)
+            tasks_runner.data_ready.clear()
+            reloader = DatasetReloader(webserver)
+
+            def global_mean(engine, _):
+                return requests_solver.global_mean(engine, "Question1")
+
+            job_ids = []
+            for question in app_constants.QUESTIONS * 3:
+                job_ids.append(webserver.jobs.new_job())
+                tasks_runner.submit(global_mean, job_ids[-1], {"question": question}, False)
+
+            # Leave time to the workers to start before the engine is swapped in
+            swap_dataset = tasks_runner.swap_dataset
+            def slow_swap_dataset(data, engine):
+                swap_dataset(data, engine)
+                sleep(0.05)
+
+            with mock.patch.object(tasks_runner, "swap_dataset", slow_swap_dataset):
+                self.assertTrue(reloader.reload())
+                for job_id in job_ids:
+                    self.assertEqual(webserver.requests_solver.wait_for_job(job_id, 5), "done")
+
+    def test_shared_dataset(self):
+        """
+        Test that a dataset attached from shared memory gives the same results
+        and is backed by the shared memory blocks
+        """
+        shared_dataset = SharedDataset(constants.mock_df3)
+        try:
+            data, blocks = attach_dataset(shared_dataset.descriptor)
+            self.assertEqual(
+                requests_solver.mean_by_category(data, "Question1"),
+                requests_solver.mean_by_category(constants.mock_df3, "Question1"),
+            )
+            self.assertFalse(data["Data_Value"].to_numpy().flags.writeable)
+
+            del data
+            for block in blocks:
+                block.close()
+        finally:
+            shared_dataset.close()
+
+    def test_process_backend(self):
+        """
+        Test that the process backend computes the jobs in the worker processes attached
+        to the shared dataset, and frees them and the shared memory when it shuts down
+        """
+        data = constants.mock_df3
+        with mock.patch.dict(os.environ, {"TP_NUM_OF_THREADS": "2"}):
+            webserver = self.make_webserver(
+                "process", data=data, solver_engine=requests_solver.create_engine("index", data)
+            )
+        tasks_runner = webserver.tasks_runner
+        block_names = [block["name"] for block in tasks_runner.shared_dataset.descriptor.values()]
+
+        job_id = webserver.jobs.new_job()
+        tasks_runner.submit(
+            worker_states_mean, job_id, {"question": constants.mock_question}, False
+        )
+        self.assertEqual(webserver.requests_solver.wait_for_job(job_id, 10), "done")
+        result = json.loads(webserver.result_store.get(job_id))
+        self.assertNotEqual(result["pid"], os.getpid())
+        self.assertEqual(result["data"], requests_solver.states_mean(data, "Question1"))
+
+        tasks_runner.shutdown()
+        with self.assertRaises(RuntimeError):
+            tasks_runner.process_pool.submit(worker_states_mean, data, None)
+        for name in block_names:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
+
+    def test_batch(self):
+        """
+        Test the batch helper function
+        """
+        items = (
+            ("mean_by_category", ("Question1",)),
+            ("state_mean", ("Question1", "State1")),
+            (None, None),
+        )
+        for data in (constants.mock_df3, AggregateIndex(constants.mock_df3)):
+            with self.subTest(data=type(data).__name__):
+                result = requests_solver.batch(data, items)
+                self.assertEqual(
+                    result,
+                    [
+                        {
+                            "endpoint": "mean_by_category",
+                            "question": "Question1",
+                            "state": None,
+                            "data": requests_solver.mean_by_category(
+                                constants.mock_df3, "Question1"
+                            ),
+                        },
+                        {
+                            "endpoint": "state_mean",
+                            "question": "Question1",
+                            "state": "State1",
+                            "data": {"State1": 69.25},
+                        },
+                        {
+                            "endpoint": None,
+                            "question": None,
+                            "state": None,
+                            "data": {"error_message": "Invalid input"},
+                        },
+                    ],
+                )
+
+    def test_job_registry(self):
+        """
+        Test the counters, the pagination and the TTL eviction of the job registry
+        """
+        evicted = []
+        registry = JobRegistry(0.1, on_evict=evicted.append)
+
+        job_ids = [registry.new_job() for _ in range(5)]
+        self.assertEqual(job_ids, [1, 2, 3, 4, 5])
+        registry.set_status(2, "done")
+        registry.set_status(4, "error")
+        self.assertEqual(registry.count("running"), 3)
+        self.assertEqual(registry.count("done"), 1)
+
+        self.assertEqual(registry.list(0, 2), ([(1, "running"), (2, "done")], 2))
+        self.assertEqual(registry.list(2, 2), ([(3, "running"), (4, "error")], 4))
+        self.assertEqual(registry.list(4, 2), ([(5, "running")], None))
+        self.assertEqual(registry.list(status="running")[0], [(1, "running"), (3, "running"),
+                                                               (5, "running")])
+
+        # The finished jobs are evicted after the TTL
+        sleep(0.2)
+        self.assertEqual(registry.count("done"), 0)
+        self.assertEqual(evicted, [2, 4])
+        self.assertIsNone(registry.get(2))
+        self.assertEqual(registry.get(3), "running")
+        self.assertEqual(registry.new_job(), 6)
+
+    def test_sampling_profiler(self):
+        """
+        Test that the sampled calls are profiled and their stats aggregated by name
+        """
+        profiler = SamplingProfiler(0)
+        self.assertEqual(profiler.run("sum", sum, [1, 2]), 3)
+        self.assertEqual(profiler.report(), {})
+
+        profiler.sample_rate = 1
+        for _ in range(3):
+            self.assertEqual(profiler.run("sum", sum, [1, 2]), 3)
+        report = profiler.report(limit=5)
+        self.assertEqual(list(report), ["sum"])
+        self.assertEqual(report["sum"]["profiled_calls"], 3)
+        self.assertIn("function calls", report["sum"]["stats"])
+
+        profiler.reset()
+        self.assertEqual(profiler.report(), {})
+
+    def test_async_logging(self):
+        """
+        Test the per-route log levels and the sampled and capped payloads
+        """
+        levels = parse_route_levels("/api/jobs=warning, /api/get_results/<job_id>=ERROR")
+        self.assertEqual(
+            levels, {"/api/jobs": logging.WARNING, "/api/get_results/<job_id>": logging.ERROR}
+        )
+        with self.assertRaises(ValueError):
+            parse_route_levels("/api/jobs=LOUD")
+
+        app = Flask(__name__)
+        app.add_url_rule("/api/jobs", "jobs", lambda: "")
+        route_filter = RouteLevelFilter(levels)
+        info = logging.LogRecord("app", logging.INFO, __file__, 0, "message", None, None)
+        warning = logging.LogRecord("app", logging.WARNING, __file__, 0, "message", None, None)
+        self.assertTrue(route_filter.filter(info))
+        with app.test_request_context("/api/jobs"):
+            self.assertFalse(route_filter.filter(info))
+            self.assertTrue(route_filter.filter(warning))
+
+        self.assertEqual(str(PayloadSampler(1, 0)(["a", "b"])), "['a', 'b']")
+        self.assertEqual(str(PayloadSampler(1, 4)("abcdef")), "abcd... (6 characters)")
+        self.assertEqual(PayloadSampler(0, 4)("abcdef"), "<not sampled>")
+
+    def test_coalescing(self):
+        """
+        Test that identical jobs submitted while one of them is computed share its result
+        """
+        webserver = self.make_webserver()
+
+        calls = []
+        def slow_endpoint(_, question):
+            calls.append(question)
+            sleep(0.2)
+            return {"result": 1}
+
+        job_ids = [webserver.jobs.new_job() for _ in range(3)]
+        for job_id in job_ids:
+            webserver.tasks_runner.submit(
+                slow_endpoint, job_id, {"question": constants.mock_question}, False
+            )
+
+        for job_id in job_ids:
+            self.assertEqual(webserver.requests_solver.wait_for_job(job_id, 5), "done")
+            self.assertEqual(webserver.result_store.get(job_id), b'{"result":1}')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(webserver.tasks_runner.coalesced_jobs, 2)
+
+    def test_metrics(self):
+        """
+        Test the rendering of the counters and histograms in the Prometheus text format
+        """
+        counter = Counter("requests_total", "Requests", ("route",))
+        counter.inc("/a")
+        counter.inc("/a", amount=2)
+        counter.inc('/"b"')
+        self.assertEqual(counter.collect(), [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/\\"b\\""} 1',
+            'requests_total{route="/a"} 3',
+        ])
+
+        histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, "/a")
+        self.assertEqual(histogram.collect()[2:], [
+            'latency_seconds_bucket{route="/a",le="0.1"} 2',
+            'latency_seconds_bucket{route="/a",le="1"} 3',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+            'latency_seconds_sum{route="/a"} 2.65',
+            'latency_seconds_count{route="/a"} 4',
+        ])
+
+    def test_rate_limiter(self):
+        """
+        Test that each client can only make a burst of requests, then has to wait
+        """
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual(limiter.acquire("client1"), 0)
+        self.assertEqual(limiter.acquire("client1"), 0)
+        self.assertEqual(limiter.acquire("client1"), 1)
+        self.assertEqual(limiter.acquire("client2"), 0)
+
+        sleep(0.15)
+        self.assertEqual(limiter.acquire("client1"), 0)
+        self.assertEqual(limiter.rejected, 1)
+
+        self.assertEqual(RateLimiter(rate=0, burst=0).acquire("client1"), 0)
+
+    def test_priority_lanes(self):
+        """
+        Test that cheap jobs overtake the heavy jobs waiting for a worker,
+        but not the heavy jobs that waited for too long
+        """
+        webserver = self.make_webserver()
+        webserver.tasks_runner.thread_pool.shutdown()
+        webserver.tasks_runner.thread_pool = ThreadPoolExecutor(max_workers=1)
+        webserver.tasks_runner.priority_slack = 1
+
+        order = []
+        def mean_by_category(_, question):
+            order.append(("heavy", question))
+            return {}
+
+        def state_mean(_, question, state):
+            order.append(("cheap", question))
+            return {state: 0}
+
+        # Keep the only worker busy until all the jobs are waiting
+        release = Event()
+        webserver.tasks_runner.thread_pool.submit(release.wait)
+
+        questions = app_constants.QUESTIONS
+        submissions = [
+            (mean_by_category, {"question": questions[0]}, False),
+            (mean_by_category, {"question": questions[1]}, False),
+            (state_mean, {"question": questions[2], "state": "Ohio"}, True),
+        ]
+        for endpoint, request_args, has_state in submissions:
+            job_id = webserver.jobs.new_job()
+            webserver.tasks_runner.submit(endpoint, job_id, request_args, has_state)
+        release.set()
+        webserver.tasks_runner.shutdown()
+
+        # The cheap job overtakes the heavy ones, which keep their submission order
+        self.assertEqual(
+            order,
+            [("cheap", questions[2]), ("heavy", questions[0]), ("heavy", questions[1])],
+        )
+
     def test_invalid_job_id(self):
         """
         Test the behavior of the webserver when an invalid job_id is provided
@@ -163,6 +897,142 @@ class TestWebserver(unittest.TestCase):
                 res.json(), {"status": "error", "data": {"error_message": "Invalid input"}}
             )
 
+    def test_sync_request(self):
+        """
+        Test that a request made with the wait query parameter returns the result directly
+        """
+        with self.subTest():
+            req_data = {"question": constants.mock_question}
+            req = requests.post("http://127.0.0.1:5000/api/global_mean?wait=5",
+                                json=req_data, timeout=10)
+            self.assertEqual(req.status_code, 200)
+            job_id = req.json()["job_id"]
+            self.assertEqual(req.json()["status"], "done")
+
+            res = requests.get(f"http://127.0.0.1:5000/api/get_results/{job_id}", timeout=10)
+            self.assertEqual(res.json(), {"status": "done", "data": req.json()["data"]})
+
+            bad_req_data = {"question": "Something not in the data"}
+            req = requests.post("http://127.0.0.1:5000/api/global_mean",
+                                json=bad_req_data, headers={"X-Wait": "5"}, timeout=10)
+            self.assertEqual(req.status_code, 400)
+            self.assertEqual(
+                req.json(),
+                {"job_id": req.json()["job_id"], "status": "error",
+                 "data": {"error_message": "Invalid input"}}
+            )
+
+    def test_long_polling(self):
+        """
+        Test that get_results called with the wait query parameter returns the finished job
+        """
+        with self.subTest():
+            req_data = {"question": constants.mock_question}
+            req = requests.post("http://127.0.0.1:5000/api/mean_by_category",
+                                json=req_data, timeout=10)
+            self.assertEqual(req.status_code, 200)
+            job_id = req.json()["job_id"]
+
+            res = requests.get(f"http://127.0.0.1:5000/api/get_results/{job_id}?wait=5",
+                               timeout=10)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json()["status"], "done")
+
+    def test_batch_request(self):
+        """
+        Test the functionality of the /api/batch endpoint
+        """
+        with self.subTest():
+            items = [
+                {"endpoint": "global_mean", "question": constants.mock_question},
+                {"endpoint": "state_mean", "question": constants.mock_question, "state": "Ohio"},
+                {"endpoint": "state_mean", "question": constants.mock_question},
+            ]
+            req = requests.post("http://127.0.0.1:5000/api/batch?wait=5",
+                                json={"items": items}, timeout=10)
+            self.assertEqual(req.status_code, 200)
+            data = req.json()["data"]
+            self.assertEqual(len(data), 3)
+            self.assertIn("global_mean", data[0]["data"])
+            self.assertIn("Ohio", data[1]["data"])
+            self.assertEqual(data[2]["data"], {"error_message": "Invalid input"})
+
+            req = requests.post("http://127.0.0.1:5000/api/batch?wait=5",
+                                json={"items": "not a list"}, timeout=10)
+            self.assertEqual(req.status_code, 400)
+
+    def test_jobs_pagination(self):
+        """
+        Test the pagination and the status filter of the /api/jobs endpoint
+        """
+        with self.subTest():
+            req_data = {"question": constants.mock_question}
+            for _ in range(3):
+                req = requests.post("http://127.0.0.1:5000/api/global_mean?wait=5",
+                                    json=req_data, timeout=10)
+                self.assertEqual(req.status_code, 200)
+
+            res = requests.get("http://127.0.0.1:5000/api/jobs?limit=2&status=done", timeout=10)
+            self.assertEqual(res.status_code, 200)
+            page = res.json()
+            self.assertEqual(len(page["data"]), 2)
+            self.assertTrue(all(list(job.values()) == ["done"] for job in page["data"]))
+
+            res = requests.get(
+                f"http://127.0.0.1:5000/api/jobs?limit=2&cursor={page['next_cursor']}",
+                timeout=10
+            )
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn(page["data"][-1], res.json()["data"])
+
+            res = requests.get("http://127.0.0.1:5000/api/jobs?limit=0", timeout=10)
+            self.assertEqual(res.status_code, 400)
+
+    def test_debug_timings(self):
+        """
+        Test that the timings of a job are returned with the debug query parameter
+        """
+        with self.subTest():
+            req_data = {"question": constants.mock_question, "state": "Ohio"}
+            req = requests.post("http://127.0.0.1:5000/api/state_mean_by_category",
+                                json=req_data, timeout=10)
+            self.assertEqual(req.status_code, 200)
+            job_id = req.json()["job_id"]
+
+            res = requests.get(
+                f"http://127.0.0.1:5000/api/get_results/{job_id}?wait=5&debug=1", timeout=10
+            )
+            self.assertEqual(res.status_code, 200)
+            timings = res.json()["timings"]
+            self.assertEqual(timings["accepted"], 0)
+            # A job answered from the cache is stored without being serialized again
+            self.assertLessEqual(timings.get("serialized", 0), timings["stored"])
+
+            res = requests.get(f"http://127.0.0.1:5000/api/get_results/{job_id}", timeout=10)
+            self.assertNotIn("timings", res.json())
+
+    def test_metrics_request(self):
+        """
+        Test that /api/metrics exposes the request counters and latency histograms
+        """
+        with self.subTest():
+            req_data = {"question": constants.mock_question}
+            req = requests.post("http://127.0.0.1:5000/api/states_mean?wait=5",
+                                json=req_data, timeout=10)
+            self.assertEqual(req.status_code, 200)
+
+            res = requests.get("http://127.0.0.1:5000/api/metrics", timeout=10)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.headers["Content-Type"].startswith("text/plain"))
+            self.assertIn("# TYPE webserver_job_compute_seconds histogram", res.text)
+            self.assertIn(
+                'webserver_http_requests_total{route="/api/states_mean",method="POST",code="200"}',
+                res.text
+            )
+            self.assertIn('webserver_job_requests_total{endpoint="states_mean",outcome="accepted"}',
+                          res.text)
+            self.assertIn('webserver_jobs{status="done"}', res.text)
+
     def test_jobs(self):
         """
         Test the functionality of the /api/jobs endpoint